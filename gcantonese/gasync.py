@@ -0,0 +1,202 @@
+#! python3
+
+import ssl
+import time
+import heapq
+import socket
+import asyncio
+import functools
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+from input_methods.gcantonese.gschedule import GRequestScheduler
+from input_methods.gcantonese.gmetrics import *
+
+# Event loop engine: every request, retry backoff and cache write runs as a task on
+# one background loop thread instead of blocking a worker thread each
+
+class GAsyncRequestScheduler(GRequestScheduler):
+    # Same priorities and prefix cancellation as GRequestScheduler, jobs are coroutine
+    # functions started as tasks on the loop, at most max_concurrency at a time
+    # submit and set_live stay callable from any thread, including the loop itself
+    def start(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.running = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.dispatch)
+
+    def dispatch(self):
+        # Loop thread, starts queued jobs while there is room
+        while True:
+            with self.condition:
+                if self.closing or len(self.queue) <= 0 or \
+                   len(self.running) >= self.max_concurrency:
+                    return
+                job = heapq.heappop(self.queue)
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            task = self.loop.create_task(job.fn(*job.args))
+            self.running.add(task)
+            task.add_done_callback(functools.partial(self.finish, job))
+
+    def finish(self, job, task):
+        self.running.discard(task)
+        if task.cancelled():
+            job.future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() != None:
+            job.future.set_exception(task.exception())
+        else:
+            job.future.set_result(task.result())
+        self.dispatch()
+
+    def call(self, coro):
+        # Runs a coroutine on the loop from any other thread, returns a concurrent future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def cancel_running(self):
+        tasks = list(self.running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self):
+        GRequestScheduler.shutdown(self)
+        if not self.loop.is_closed():
+            self.call(self.cancel_running()).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+class GAsyncConnectionPool:
+    # Keep-alive HTTP(S) connections over asyncio streams, same reuse rules as GConnectionPool
+    # Only used on the loop thread, except for close
+    def __init__(self, url, loop, max_size, idle_timeout):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.port = parts.port if parts.port != None else (443 if self.ssl != None else 80)
+        self.path = parts.path if len(parts.path) > 0 else "/"
+        self.loop = loop
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.closing = False
+
+    async def new_connection(self):
+        metrics.count("pool.created")
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def acquire(self):
+        # Returns ((reader, writer), reused)
+        now = time.time()
+        while len(self.idle) > 0:
+            reader, writer, last_used = self.idle.pop()
+            if now - last_used > self.idle_timeout or reader.at_eof():
+                writer.close()
+            else:
+                metrics.count("pool.reused")
+                return (reader, writer), True
+        return await self.new_connection(), False
+
+    def release(self, conn):
+        if not self.closing and len(self.idle) < self.max_size:
+            self.idle.append((conn[0], conn[1], time.time()))
+            return
+        conn[1].close()
+
+    async def exchange(self, conn, params_str):
+        # Sends one GET and reads the response, returns (status, reason, will_close, body)
+        reader, writer = conn
+        writer.write("GET {}?{} HTTP/1.1\r\nHost: {}\r\nAccept-Encoding: identity\r\n\r\n".format(
+            self.path, params_str, self.host).encode("ascii"))
+        await writer.drain()
+        line = await reader.readline()
+        if len(line) <= 0:
+            raise ConnectionResetError("Connection closed by server")
+        parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(line)
+        version, status = parts[0], int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ""
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        will_close = connection == "close" or (version == "HTTP/1.0" and connection != "keep-alive")
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size <= 0:
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+            # Skips trailers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = bytes(body)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            will_close = True
+        return status, reason, will_close, body
+
+    async def fetch(self, params_str):
+        # A reused connection the server has already dropped is retried once on a fresh one
+        conn, reused = await self.acquire()
+        while True:
+            metrics.count("pool.requests")
+            try:
+                status, reason, will_close, body = await self.exchange(conn, params_str)
+                break
+            except asyncio.CancelledError:
+                conn[1].close()
+                raise
+            except (OSError, EOFError, ValueError, http.client.HTTPException) as e:
+                conn[1].close()
+                if not reused:
+                    if isinstance(e, (OSError, http.client.HTTPException)):
+                        raise
+                    raise ConnectionError("Malformed response: {}".format(e)) from e
+                conn, reused = await self.new_connection(), False
+        if will_close:
+            conn[1].close()
+        else:
+            self.release(conn)
+        if status != 200:
+            raise http.client.HTTPException("HTTP {} {}".format(status, reason))
+        return body
+
+    async def get(self, params_str, timeout):
+        # Sends a GET with the given query string and returns the response body
+        try:
+            return await asyncio.wait_for(self.fetch(params_str), timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+
+    async def close_idle(self):
+        idle = self.idle
+        self.idle = []
+        for _, writer, _ in idle:
+            writer.close()
+        for _, writer, _ in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def close(self):
+        # Callable from any thread while the loop is still running
+        self.closing = True
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.close_idle(), self.loop).result()
@@ -0,0 +1,403 @@
+#! python3
+
+# Headless keystroke-replay benchmark
+# Drives GCantoneseTextService through recorded key traces against a local fake
+# Input Tools server and reports how long key handling blocks and how long
+# candidates take to appear, first any page then one that is not provisional
+#
+# Usage: python gbench.py [--trace traces.json] [--latency 0.08] [--jitter 0.04]
+#                         [--failure-rate 0.05] [--json result.json]
+#                         [--baseline previous.json] [--check-offline]
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import contextlib
+import tempfile
+import threading
+import socketserver
+import http.server
+import urllib.parse
+
+KEYCODES = {
+    "VK_BACK": 0x08, "VK_TAB": 0x09, "VK_RETURN": 0x0D, "VK_SHIFT": 0x10,
+    "VK_CONTROL": 0x11, "VK_MENU": 0x12, "VK_CAPITAL": 0x14, "VK_ESCAPE": 0x1B,
+    "VK_SPACE": 0x20, "VK_LEFT": 0x25, "VK_UP": 0x26, "VK_RIGHT": 0x27,
+    "VK_DOWN": 0x28, "VK_OEM_1": 0xBA, "VK_OEM_PLUS": 0xBB, "VK_OEM_COMMA": 0xBC,
+    "VK_OEM_MINUS": 0xBD, "VK_OEM_PERIOD": 0xBE, "VK_OEM_2": 0xBF, "VK_OEM_3": 0xC0,
+    "VK_OEM_4": 0xDB, "VK_OEM_5": 0xDC, "VK_OEM_6": 0xDD, "VK_OEM_7": 0xDE
+}
+
+KEY_NAMES = {
+    "SPACE": "VK_SPACE", "BACK": "VK_BACK", "LEFT": "VK_LEFT", "RIGHT": "VK_RIGHT",
+    "UP": "VK_UP", "DOWN": "VK_DOWN", "ENTER": "VK_RETURN", "ESC": "VK_ESCAPE"
+}
+
+# Typing, space, arrows, backspace and digit selection
+DEFAULT_TRACES = [
+    ("type-space", "N E I H H O U SPACE SPACE"),
+    ("digit-select", "N G O D E I SPACE 2 ENTER"),
+    ("browse-pages", "S I K F A A N SPACE RIGHT RIGHT DOWN DOWN UP SPACE ENTER"),
+    ("backspace", "G A M Y A T BACK BACK Y A T SPACE SPACE"),
+    ("continuous", "N E I H O U M A SPACE H A I M A I SPACE SPACE ENTER"),
+    ("retype", "N E I H H O U SPACE ESC N E I H H O U SPACE SPACE"),
+    ("partial-select", "N E I H O U M A SPACE 2 SPACE ENTER")
+]
+
+class FakeClient:
+    isWindows8Above = False
+
+class FakeTextService:
+    # Minimal stand-in for PIME's textService.TextService
+    def __init__(self, client):
+        self.client = client
+        self.compositionString = ""
+        self.commitString = ""
+        self.candidateList = []
+        self.showCandidates = False
+        self.candidateCursor = 0
+        self.committed = []
+
+    def onActivate(self):
+        pass
+
+    def onDeactivate(self):
+        pass
+
+    def addButton(self, *args, **kwargs):
+        pass
+
+    def changeButton(self, *args, **kwargs):
+        pass
+
+    def removeButton(self, *args, **kwargs):
+        pass
+
+    def isComposing(self):
+        return self.compositionString != ""
+
+    def setCompositionString(self, s):
+        self.compositionString = s
+
+    def setCommitString(self, s):
+        self.commitString = s
+        if len(s) > 0:
+            self.committed.append(s)
+
+    def setCandidateList(self, candidates):
+        self.candidateList = candidates
+
+    def setShowCandidates(self, show):
+        self.showCandidates = show
+
+    def setCandidateCursor(self, cursor):
+        self.candidateCursor = cursor
+
+class FakeKeyEvent:
+    def __init__(self, keyCode, down=()):
+        self.keyCode = keyCode
+        self.down = set(down)
+
+    def isKeyDown(self, code):
+        return code in self.down
+
+    def isKeyToggled(self, code):
+        return False
+
+def install_package():
+    # Makes the package importable outside PIME
+    if "input_methods" not in sys.modules:
+        try:
+            import input_methods.gcantonese
+        except ImportError:
+            module = types.ModuleType("input_methods")
+            module.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+            sys.modules["input_methods"] = module
+
+def install_fake_host():
+    # Makes gcanton importable outside PIME, real PIME modules win if present
+    install_package()
+    try:
+        import keycodes
+    except ImportError:
+        module = types.ModuleType("keycodes")
+        module.__dict__.update(KEYCODES)
+        sys.modules["keycodes"] = module
+    try:
+        import textService
+    except ImportError:
+        module = types.ModuleType("textService")
+        module.TextService = FakeTextService
+        sys.modules["textService"] = module
+
+class FakeInputToolsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.server.count("connections")
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        delay = max(0, server.latency + random.uniform(-server.jitter, server.jitter))
+        if random.random() < server.slow_rate:
+            # Occasional stragglers make up the latency tail
+            delay += server.slow_latency
+        time.sleep(delay)
+        if random.random() < server.failure_rate:
+            server.count("failures")
+            self.send_error(503)
+            return
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        body = json.dumps(fake_response(params["text"][0], int(params["num"][0])))
+        body = body.encode("utf-8")
+        server.count("bytes", len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def fake_response(text, num):
+    # Shaped like an Input Tools response, half of the suggestions match only
+    # part of the input so selecting them leaves a leftover
+    real_input = text.split(",")[-1] if text.startswith("|") else text
+    words = []
+    annotations = []
+    matched_lengths = []
+    for i in range(min(num, 8 * len(real_input))):
+        matched_length = len(real_input) if i % 2 == 0 else max(1, len(real_input) - 1 - i % 3)
+        words.append("{}{}".format(real_input[:matched_length].upper(), i))
+        annotations.append(real_input[:matched_length])
+        matched_lengths.append(matched_length)
+    return ["SUCCESS", [[text, words, [], {
+        "annotation": annotations,
+        "matched_length": matched_lengths
+    }]]]
+
+class FakeInputToolsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.08, jitter=0.04, failure_rate=0.0, slow_rate=0.0, slow_latency=0.8):
+        http.server.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeInputToolsHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.counts = {"connections": 0, "requests": 0, "failures": 0, "aborted": 0, "bytes": 0}
+        self.countlock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/request".format(self.server_address[1])
+
+    def count(self, name, n=1):
+        with self.countlock:
+            self.counts[name] += n
+
+    def handle_error(self, request, client_address):
+        # Clients abort requests on purpose, e.g. losing hedges, keep them out of the report
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            self.count("aborted")
+            return
+        http.server.HTTPServer.handle_error(self, request, client_address)
+
+def parse_trace(tokens, interval):
+    # "N E I SPACE" style token strings, every key is pressed interval seconds apart
+    return list(map(lambda x: (x, interval), tokens.split()))
+
+def load_traces(path):
+    # [{"name": ..., "events": [["N", 0.12], ["SPACE", 0.3], ...]}, ...]
+    # Delays are seconds since the previous key
+    with open(path, encoding="utf-8") as f:
+        return list(map(lambda x: (x["name"], list(map(tuple, x["events"]))), json.load(f)))
+
+def key_code(token):
+    keycodes = sys.modules["keycodes"]
+    if token in KEY_NAMES:
+        return getattr(keycodes, KEY_NAMES[token])
+    return ord(token.upper())
+
+def percentiles(samples):
+    if len(samples) <= 0:
+        return {"p50": 0, "p95": 0, "p99": 0, "max": 0}
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": samples[-1] * 1000}
+
+def replay(service, events, keyup_delay, result):
+    # A provisional page, from the lexicon or learned phrases, counts as candidates
+    # shown but not as real candidates, which come from the server or the cache
+    pending_since = None
+    real_pending_since = None
+    def check_candidates(now):
+        nonlocal pending_since, real_pending_since
+        if pending_since != None and service.showCandidates:
+            result["time_to_candidates"].append(now - pending_since)
+            pending_since = None
+        if real_pending_since != None and service.showCandidates and \
+           service.selected_page != None and not service.selected_page.provisional:
+            result["time_to_real_candidates"].append(now - real_pending_since)
+            real_pending_since = None
+    for token, delay in events:
+        time.sleep(max(0, delay - keyup_delay))
+        event = FakeKeyEvent(key_code(token))
+        wants_candidates = token in ("SPACE", "UP", "DOWN") and \
+                           service.isComposing() and not service.showCandidates
+        start = time.perf_counter()
+        if service.filterKeyDown(event):
+            service.onKeyDown(event)
+        end = time.perf_counter()
+        result["key_latency"].append(end - start)
+        if pending_since != None and not service.isComposing():
+            result["candidates_missed"] += 1
+            pending_since = None
+        if real_pending_since != None and not service.isComposing():
+            result["real_candidates_missed"] += 1
+            real_pending_since = None
+        if wants_candidates:
+            if pending_since != None:
+                result["candidates_missed"] += 1
+            if real_pending_since != None:
+                result["real_candidates_missed"] += 1
+            pending_since = start
+            real_pending_since = start
+        check_candidates(end)
+        time.sleep(keyup_delay)
+        if service.filterKeyUp(event):
+            service.onKeyUp(event)
+        check_candidates(time.perf_counter())
+    if pending_since != None:
+        result["candidates_missed"] += 1
+    if real_pending_since != None:
+        result["real_candidates_missed"] += 1
+    if service.isComposing():
+        service.commit_composition()
+
+def run(traces, latency, jitter, failure_rate, keyup_delay, rounds, cold, engine=None,
+        slow_rate=0.0, slow_latency=0.8):
+    install_fake_host()
+    from input_methods.gcantonese import gretrieve
+    from input_methods.gcantonese.gcanton import GCantoneseTextService
+    from input_methods.gcantonese.gmetrics import metrics
+    server = FakeInputToolsServer(latency, jitter, failure_rate, slow_rate, slow_latency)
+    gretrieve.REQUEST_URL = server.url
+    if engine != None:
+        gretrieve.REQUEST_ENGINE = engine
+    appdata = tempfile.mkdtemp()
+    os.environ["APPDATA"] = appdata
+    result = {"key_latency": [], "time_to_candidates": [], "candidates_missed": 0,
+              "time_to_real_candidates": [], "real_candidates_missed": 0}
+    metrics.reset()
+    service = None
+    try:
+        for _ in range(rounds):
+            for name, events in traces:
+                if service == None:
+                    service = GCantoneseTextService(FakeClient())
+                    service.onActivate()
+                replay(service, events, keyup_delay, result)
+                if cold:
+                    service.onDeactivate()
+                    service = None
+                    shutil.rmtree(appdata, ignore_errors=True)
+    finally:
+        if service != None:
+            service.onDeactivate()
+        server.shutdown()
+        shutil.rmtree(appdata, ignore_errors=True)
+    hits = metrics.counter("cache.hit")
+    misses = metrics.counter("cache.miss")
+    return {
+        "keystrokes": len(result["key_latency"]),
+        "key_latency_ms": percentiles(result["key_latency"]),
+        "time_to_candidates_ms": percentiles(result["time_to_candidates"]),
+        "candidates_shown": len(result["time_to_candidates"]),
+        "candidates_missed": result["candidates_missed"],
+        "time_to_real_candidates_ms": percentiles(result["time_to_real_candidates"]),
+        "real_candidates_shown": len(result["time_to_real_candidates"]),
+        "real_candidates_missed": result["real_candidates_missed"],
+        "cache_hit_ratio": hits / (hits + misses) if hits + misses > 0 else 0,
+        "outbound_requests": server.counts["requests"],
+        "outbound_failures": server.counts["failures"],
+        "outbound_aborted": server.counts["aborted"],
+        "outbound_kib": server.counts["bytes"] / 1024,
+        "connections": server.counts["connections"],
+        "pool_created": metrics.counter("pool.created"),
+        "pool_reused": metrics.counter("pool.reused")
+    }
+
+def print_report(report, baseline=None):
+    def line(name, value, base):
+        if base == None:
+            print("{:<32}{:>12.2f}".format(name, value))
+        else:
+            print("{:<32}{:>12.2f}{:>12.2f}{:>+11.1f}%".format(
+                name, value, base, (value - base) / base * 100 if base else 0))
+    for key, value in report.items():
+        base = baseline.get(key) if baseline != None else None
+        if type(value) is dict:
+            for p, v in value.items():
+                line("{} {}".format(key, p), v, base[p] if base != None else None)
+        else:
+            line(key, value, base)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Keystroke-replay latency benchmark")
+    parser.add_argument("--trace", help="JSON file of recorded traces")
+    parser.add_argument("--interval", type=float, default=0.12, help="seconds between keys of built-in traces")
+    parser.add_argument("--keyup", type=float, default=0.04, help="seconds between key down and key up")
+    parser.add_argument("--latency", type=float, default=0.08, help="fake server latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.04, help="fake server jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of responses delayed by --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=0.8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--cold", action="store_true", help="fresh cache for every trace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=["thread", "async"], help="retrieval engine, see gretrieve")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare against a previously written report")
+    parser.add_argument("--check-offline", action="store_true",
+                        help="replay once against a server failing every request, exits with 1 "
+                             "if candidates are ever missed")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    if args.trace != None:
+        traces = load_traces(args.trace)
+    else:
+        traces = list(map(lambda x: (x[0], parse_trace(x[1], args.interval)), DEFAULT_TRACES))
+    if args.check_offline:
+        # The lexicon has to stand in for the server on every Space, see try_get_page
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = run(traces, args.latency, args.jitter, 1.0, args.keyup, 1, args.cold, args.engine)
+        print_report(report)
+        if report["candidates_missed"] > 0 or report["candidates_shown"] <= 0:
+            print("Offline check failed: {} missed".format(report["candidates_missed"]))
+            sys.exit(1)
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = run(traces, args.latency, args.jitter, args.failure_rate, args.keyup,
+                     args.rounds, args.cold, args.engine, args.slow_rate, args.slow_latency)
+    baseline = None
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json != None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,103 +1,610 @@
 #! python3
 
-import json
-import zlib
+import os
 import time
 import sqlite3
 import threading
+import collections
 from input_methods.gcantonese.gtypes import *
+from input_methods.gcantonese.gprefix import GPrefixIndex, split_query
+from input_methods.gcantonese.gcodec import *
+from input_methods.gcantonese.gsnapshot import GHotSnapshot, write_snapshot
+from input_methods.gcantonese.gtrace import GAccessTrace, OP_HIT, OP_MISS, OP_PUT
+from input_methods.gcantonese.gmetrics import *
+
+MEMORY_CACHE_MAX_ENTRIES = 512
+MEMORY_CACHE_MAX_SUGGESTIONS = 16384
+WRITE_BEHIND_INTERVAL = 1.0
+WRITE_BEHIND_BATCH_MAX = 64
+CACHE_SCHEMA_VERSION = 4
+SNAPSHOT_MAX_ENTRIES = 2000
+# Budget of the sqlite cache, enforced by the maintenance task while the IME is idle
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+CACHE_MAX_ENTRIES = 20000
+CACHE_PAGE_CACHE_KIB = 2048
+MAINTENANCE_IDLE_TIME = 5.0
+MAINTENANCE_INTERVAL = 300.0
+EVICTION_BATCH_SIZE = 100
+VACUUM_BATCH_PAGES = 256
+# Each retrieval keeps an entry as if it had been used this many seconds later, 0 for plain LRU
+EVICTION_HIT_WEIGHT = 86400
+EVICTION_HIT_MAX = 30
+
+class GMemoryCache:
+    # Bounded LRU of decoded request metadata and pages kept in front of the sqlite cache
+    # Entry size is counted in suggestions, metadata entries count as one
+    # Not thread safe by itself, callers should hold GCacheService.threadlock
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES,
+                 max_suggestions=MEMORY_CACHE_MAX_SUGGESTIONS):
+        self.max_entries = max_entries
+        self.max_suggestions = max_suggestions
+        self.entries = collections.OrderedDict()
+        self.total_suggestions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry == None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        self.invalidate(key)
+        if size > self.max_suggestions:
+            return
+        self.entries[key] = (value, size)
+        self.total_suggestions += size
+        while len(self.entries) > self.max_entries or \
+              self.total_suggestions > self.max_suggestions:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_suggestions -= evicted[1]
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            self.total_suggestions -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.total_suggestions = 0
+
+def request_meta(grequest):
+    # Copy of a GRequest without its suggestions
+    meta = GRequest()
+    meta.request = grequest.request
+    meta.requested_pages = grequest.requested_pages
+    meta.max_pages = grequest.max_pages
+    meta.requested_time = grequest.requested_time
+    return meta
+
+def request_pages(grequest):
+    return list(map(lambda i: page_view(grequest.suggestions, i), range(grequest.requested_pages)))
+
+def request_size(query, pages):
+    # Bytes stored for a request with the given encoded pages
+    return len(query.encode("utf-8")) + sum(map(len, pages))
+
+def read_entries(conn, limit=-1):
+    # (meta, encoded pages) of the stored requests, most recently used first, as
+    # written by write_snapshot, a negative limit reads all of them
+    entries = []
+    rows = conn.execute("""
+        SELECT id, request, cached_pages, max_pages, requested_time
+        FROM requests
+        ORDER BY last_retrieved DESC
+        LIMIT ?;
+    """, (limit,)).fetchall()
+    for row in rows:
+        meta = GRequest()
+        meta.request = row[1]
+        meta.requested_pages = row[2]
+        meta.max_pages = row[3]
+        meta.requested_time = row[4]
+        pages = list(map(lambda x: bytes(x[0]), conn.execute("""
+            SELECT suggestions FROM pages WHERE request_id = ? ORDER BY page_num;
+        """, (row[0],))))
+        entries.append((meta, pages))
+    return entries
 
 class GCacheService:
-    def __init__(self, cache_path):
+    def __init__(self, cache_path, snapshot_path=None, seed_path=None, trace_path=None):
         self.threadlock = threading.Lock()
         self.cache_path = cache_path
-        self.prepare_db()
+        # Bundled entries imported into a new, empty cache, see gseed
+        self.seed_path = seed_path
+        if snapshot_path == None:
+            snapshot_path = os.path.splitext(cache_path)[0] + ".snapshot"
+        self.snapshot_path = snapshot_path
+        # Most recently used entries of the last session, usable before sqlite is open
+        # Entries put since then are stale in the snapshot
+        self.snapshot = GHotSnapshot.open(snapshot_path)
+        self.snapshot_stale = set()
+        self.db_ready = threading.Event()
+        self.memory = GMemoryCache()
+        self.index = GPrefixIndex()
+        # Write-behind queues, flushed in batches by the writer thread
+        self.pending_puts = collections.OrderedDict()
+        self.flushing_puts = {}
+        self.touched = {}
+        self.touched_hits = collections.Counter()
+        self.last_activity = time.time()
+        self.last_maintenance = 0.0
+        self.flush_event = threading.Event()
+        self.closing = False
+        # Opt-in log of lookups and writes for tuning eviction offline, see gtrace
+        self.trace = None
+        if trace_path != None:
+            try:
+                self.trace = GAccessTrace(trace_path)
+            except OSError as e:
+                metrics.log(LEVEL_WARNING, "Cache trace unavailable: {}", e)
+        self.writer = threading.Thread(target=self.write_behind, daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+        # Only takes effect on a new database, existing ones are converted in prepare_db
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA cache_size=-{};".format(CACHE_PAGE_CACHE_KIB))
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA foreign_keys=ON;")
+        return conn
 
     def prepare_db(self):
-        # Creates the table if not already existing, called on init
-        # Validations / version checking should be done here in the future
-        with sqlite3.connect(self.cache_path) as conn:
-            conn.executescript("""
-                CREATE TABLE IF NOT EXISTS requests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request TEXT NOT NULL UNIQUE,
-                    suggestions BLOB NOT NULL,
-                    cached_pages INTEGER NOT NULL,
-                    max_pages INTEGER NOT NULL,
-                    requested_time REAL NOT NULL,
-                    last_retrieved REAL NOT NULL
-                );
-                CREATE UNIQUE INDEX IF NOT EXISTS request_idx ON requests(request);
-            """)
-            conn.commit()
+        # Creates or migrates the tables, called on the writer thread
+        self.conn = self.connect()
+        if self.conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            # Switching an existing database to incremental auto-vacuum needs a full VACUUM, done once
+            self.conn.execute("VACUUM;")
+        self.migrate_db()
+        requests = list(map(lambda x: x[0], self.conn.execute("SELECT request FROM requests;")))
+        with self.threadlock:
+            for request in requests:
+                self.index.add(request)
+
+    def create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                request TEXT NOT NULL UNIQUE,
+                cached_pages INTEGER NOT NULL,
+                max_pages INTEGER NOT NULL,
+                requested_time REAL NOT NULL,
+                last_retrieved REAL NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS request_idx ON requests(request);")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                request_id INTEGER NOT NULL REFERENCES requests(id) ON DELETE CASCADE,
+                page_num INTEGER NOT NULL,
+                suggestions BLOB NOT NULL,
+                PRIMARY KEY (request_id, page_num)
+            );
+        """)
+
+    def migrate_db(self):
+        version = self.conn.execute("PRAGMA user_version;").fetchone()[0]
+        if version >= CACHE_SCHEMA_VERSION:
+            return
+        columns = list(map(lambda x: x[1], self.conn.execute("PRAGMA table_info(requests);")))
+        with self.conn:
+            if "suggestions" in columns:
+                # Version 0 kept all suggestions of a request in one blob, split it into pages
+                self.conn.execute("DROP INDEX IF EXISTS request_idx;")
+                self.conn.execute("ALTER TABLE requests RENAME TO requests_v0;")
+                self.create_tables()
+                rows = self.conn.execute("""
+                    SELECT request, suggestions, cached_pages, max_pages,
+                           requested_time, last_retrieved
+                    FROM requests_v0;
+                """).fetchall()
+                for row in rows:
+                    grequest = GRequest()
+                    grequest.request = row[0]
+                    grequest.suggestions = decode_suggestions(row[1])
+                    grequest.requested_pages = row[2]
+                    grequest.max_pages = row[3]
+                    grequest.requested_time = row[4]
+                    self.write_request(self.conn, grequest, row[5])
+                self.conn.execute("DROP TABLE requests_v0;")
+            else:
+                self.create_tables()
+            columns = list(map(lambda x: x[1], self.conn.execute("PRAGMA table_info(requests);")))
+            if "size" not in columns:
+                # Version 3 had no size and hit columns for the eviction budget
+                self.conn.execute("ALTER TABLE requests ADD COLUMN size INTEGER NOT NULL DEFAULT 0;")
+                self.conn.execute("ALTER TABLE requests ADD COLUMN hits INTEGER NOT NULL DEFAULT 0;")
+            if version == 2:
+                # Version 2 pages are zlib-compressed JSON, re-encode them in the binary format
+                rows = self.conn.execute("SELECT request_id, page_num, suggestions FROM pages;")
+                self.conn.executemany("""
+                    UPDATE pages SET suggestions = ? WHERE request_id = ? AND page_num = ?;
+                """, [(sqlite3.Binary(encode_suggestions(decode_suggestions(x[2]))), x[0], x[1])
+                      for x in rows.fetchall() if not is_current_format(x[2])])
+            if version < 4:
+                self.conn.execute("""
+                    UPDATE requests SET size = length(CAST(request AS BLOB)) + (
+                        SELECT coalesce(sum(length(suggestions)), 0)
+                        FROM pages WHERE pages.request_id = requests.id
+                    );
+                """)
+            self.conn.execute("PRAGMA user_version = {};".format(CACHE_SCHEMA_VERSION))
+
+    def write_request(self, conn, grequest, last_retrieved):
+        # Upserts the request row, then rewrites only the pages whose content changed
+        # so escalating from 2 to 4 pages appends pages 2 and 3 and leaves the rest alone
+        pages = list(map(encode_suggestions, request_pages(grequest)))
+        size = request_size(grequest.request, pages)
+        params = (grequest.requested_pages, grequest.max_pages, grequest.requested_time,
+                  last_retrieved, size, grequest.request)
+        cur = conn.execute("""
+            UPDATE requests SET cached_pages = ?, max_pages = ?, requested_time = ?,
+                                last_retrieved = ?, size = ?
+            WHERE request = ?;
+        """, params)
+        if cur.rowcount <= 0:
+            conn.execute("""
+                INSERT INTO requests(cached_pages, max_pages, requested_time,
+                                     last_retrieved, size, request)
+                VALUES(?,?,?,?,?,?);
+            """, params)
+        id = conn.execute("SELECT id FROM requests WHERE request = ?;",
+                          (grequest.request,)).fetchone()[0]
+        stored = dict(conn.execute("SELECT page_num, suggestions FROM pages WHERE request_id = ?;",
+                                   (id,)).fetchall())
+        conn.executemany("""
+            INSERT OR REPLACE INTO pages(request_id, page_num, suggestions) VALUES(?,?,?);
+        """, [(id, i, sqlite3.Binary(x)) for i, x in enumerate(pages) if stored.get(i) != x])
+        conn.execute("DELETE FROM pages WHERE request_id = ? AND page_num >= ?;", (id, len(pages)))
+
+    def import_seed(self, conn, seed_path):
+        # Loads a seed file in a single transaction, requests already cached are kept
+        # Returns the imported request keys
+        seed = GHotSnapshot.open(seed_path)
+        if seed == None:
+            return []
+        imported = []
+        current_time = time.time()
+        try:
+            with conn:
+                existing = set(map(lambda x: x[0], conn.execute("SELECT request FROM requests;")))
+                for meta, pages in seed.entries():
+                    if meta.request in existing:
+                        continue
+                    grequest = request_meta(meta)
+                    grequest.suggestions = []
+                    for page in pages:
+                        grequest.suggestions.extend(decode_suggestions(page))
+                    self.write_request(conn, grequest, current_time)
+                    imported.append(meta.request)
+        except (sqlite3.Error, ValueError) as e:
+            metrics.log(LEVEL_WARNING, "Failed to import seed: {}", e)
+            imported = []
+        finally:
+            seed.close()
+        with self.threadlock:
+            for request in imported:
+                self.index.add(request)
+        metrics.log(LEVEL_INFO, "Imported {} requests from {}", len(imported), seed_path)
+        return imported
+
+    def write_behind(self):
+        # Writer thread, opens the database off the caller's thread, then keeps
+        # its own connection so reads never wait for fsync
+        try:
+            self.prepare_db()
+        finally:
+            self.db_ready.set()
+        conn = self.connect()
+        # Seeds a new cache here rather than in prepare_db so lookups need not wait for it
+        if self.seed_path != None and os.path.exists(self.seed_path) and \
+           conn.execute("SELECT id FROM requests LIMIT 1;").fetchone() == None:
+            self.import_seed(conn, self.seed_path)
+        while not self.closing:
+            self.flush_event.wait(WRITE_BEHIND_INTERVAL)
+            self.flush_event.clear()
+            self.flush(conn)
+            self.flush_trace()
+            if self.is_idle():
+                self.maintain(conn)
+        self.flush(conn)
+        conn.close()
+
+    def flush_trace(self):
+        # A trace that fails to write stops recording on its own
+        if self.trace == None:
+            return
+        try:
+            self.trace.flush()
+        except OSError as e:
+            metrics.log(LEVEL_WARNING, "Cache trace stopped: {}", e)
+
+    def flush(self, conn):
+        with self.threadlock:
+            if len(self.pending_puts) <= 0 and len(self.touched) <= 0:
+                return
+            self.flushing_puts = self.pending_puts
+            self.pending_puts = collections.OrderedDict()
+            touched = self.touched
+            self.touched = {}
+            touched_hits = self.touched_hits
+            self.touched_hits = collections.Counter()
+        with conn:
+            for grequest in self.flushing_puts.values():
+                self.write_request(conn, grequest,
+                                   touched.pop(grequest.request, grequest.requested_time))
+            conn.executemany("""
+                UPDATE requests SET last_retrieved = ?, hits = hits + ? WHERE request = ?
+            """, [(t, touched_hits[q], q) for q, t in touched.items()])
+        with self.threadlock:
+            self.flushing_puts = {}
+
+    def is_idle(self):
+        current_time = time.time()
+        return current_time - self.last_activity >= MAINTENANCE_IDLE_TIME and \
+               current_time - self.last_maintenance >= MAINTENANCE_INTERVAL
+
+    def select_evictions(self, conn):
+        # Ids and keys of the next batch to evict: expired or oversized entries first,
+        # then the least recently used ones while the cache is over its budget
+        current_time = time.time()
+        rows = conn.execute("""
+            SELECT id, request FROM requests WHERE
+                /* Remove super large requests */
+                length(request) > 50 OR
+                /* Remove entries older than 30 days */
+                last_retrieved < (? - 2592000) OR
+                /* Remove large entries older than 7 days */
+                (length(request) > 20 AND last_retrieved < (? - 604800))
+            LIMIT ?;
+        """, (current_time, current_time, EVICTION_BATCH_SIZE)).fetchall()
+        if len(rows) > 0:
+            return rows
+        entries, size = conn.execute("SELECT count(*), coalesce(sum(size), 0) FROM requests;").fetchone()
+        metrics.gauge("cache.db_entries", entries)
+        metrics.gauge("cache.db_bytes", size)
+        if entries <= CACHE_MAX_ENTRIES and size <= CACHE_MAX_BYTES:
+            return []
+        rows = conn.execute("""
+            SELECT id, request, size FROM requests
+            ORDER BY last_retrieved + min(hits, ?) * ? ASC
+            LIMIT ?;
+        """, (EVICTION_HIT_MAX, EVICTION_HIT_WEIGHT, EVICTION_BATCH_SIZE)).fetchall()
+        # Stops at whichever budget is the last one exceeded
+        count = 0
+        for row in rows:
+            if entries <= CACHE_MAX_ENTRIES and size <= CACHE_MAX_BYTES:
+                break
+            entries -= 1
+            size -= row[2]
+            count += 1
+        return list(map(lambda x: x[:2], rows[:count]))
+
+    def maintain(self, conn):
+        # Writer thread, evicts in small batches and gives up as soon as the IME is used again
+        # Each batch is its own transaction so readers never wait on a long delete
+        evicted = 0
+        while not self.closing and self.is_idle():
+            # Scans on the writer's own connection, lookups do not wait for it
+            rows = self.select_evictions(conn)
+            with self.threadlock:
+                # Keys put since the last flush are rewritten by the next one, leave them alone
+                rows = list(filter(lambda x: x[1] not in self.pending_puts, rows))
+            if len(rows) <= 0:
+                break
+            with conn:
+                conn.executemany("DELETE FROM requests WHERE id = ?;", [(x[0],) for x in rows])
+            with self.threadlock:
+                for _, request in rows:
+                    if request in self.pending_puts:
+                        continue
+                    self.index.remove(request)
+                    # The hot snapshot must not serve it either
+                    self.snapshot_stale.add(request)
+                    self.memory.invalidate(request)
+                    for page_num in range(REQUEST_MAX_PAGES):
+                        self.memory.invalidate((request, page_num))
+            evicted += len(rows)
+        else:
+            return
+        if evicted > 0:
+            metrics.count("cache.evicted", evicted)
+            metrics.log(LEVEL_DEBUG, "Evicted {} cache entries", evicted)
+        # Returns the freed pages to the file system a few at a time
+        while not self.closing and self.is_idle():
+            if conn.execute("PRAGMA freelist_count;").fetchone()[0] <= 0:
+                break
+            conn.executescript("PRAGMA incremental_vacuum({});".format(VACUUM_BATCH_PAGES))
+        else:
+            return
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        self.last_maintenance = time.time()
+
+    def get_pending(self, query):
+        # Looks up writes not yet visible in the database, caller should hold threadlock
+        result = self.pending_puts.get(query)
+        if result == None:
+            result = self.flushing_puts.get(query)
+        return result
 
     def is_request_in_cache(self, query):
         with self.threadlock:
-            with sqlite3.connect(self.cache_path) as conn:
-                cur = conn.execute("SELECT 1 FROM requests WHERE request = ?;", (query,))
-                return cur.fetchone() != None
+            if query in self.index:
+                return True
+            return self.snapshot != None and query in self.snapshot and \
+                   query not in self.snapshot_stale
+
+    def longest_cached_prefix(self, query):
+        # Longest cached request that query extends, keeping the same committed context
+        context, _ = split_query(query)
+        with self.threadlock:
+            return self.index.longest_prefix(query, len(context) + 1)
 
     def put(self, grequest):
         with self.threadlock:
-            with sqlite3.connect(self.cache_path) as conn:
-                suggestions = list(map(lambda x: (x.word, x.annotation, x.matched_length),
-                                   grequest.suggestions))
-                conn.execute("""
-                    INSERT OR REPLACE INTO requests(request, suggestions, cached_pages,
-                                                    max_pages, requested_time, last_retrieved)
-                    VALUES(?,?,?,?,?,?)
-                """, (
-                        grequest.request,
-                        sqlite3.Binary(
-                            zlib.compress(json.dumps(
-                                    suggestions, separators=(',', ':')
-                                ).encode('utf-8')
-                            )
-                        ),
-                        grequest.requested_pages,
-                        grequest.max_pages,
-                        grequest.requested_time,
-                        grequest.requested_time
-                     )
-                )
-                conn.commit()
+            self.store(grequest)
+        self.record_put(grequest)
 
-    def get(self, query):
+    def put_if_newer(self, grequest):
+        # Puts grequest unless the cache holds a response requested after it, returns
+        # whether it was put, only the request time of the cached entry is looked up
+        query = grequest.request
+        with self.threadlock:
+            cached = self.memory.get(query)
+            if cached == None:
+                cached = self.get_pending(query)
+            if cached != None:
+                requested_time = cached.requested_time
+            elif query in self.index and self.db_ready.is_set():
+                row = self.conn.execute("""
+                    SELECT requested_time FROM requests WHERE request = ?;
+                """, (query,)).fetchone()
+                requested_time = row[0] if row != None else 0
+            else:
+                requested_time = 0
+            if requested_time > grequest.requested_time:
+                return False
+            self.store(grequest)
+        self.record_put(grequest)
+        return True
+
+    def store(self, grequest):
+        # Caller should hold threadlock
+        for page_num in range(REQUEST_MAX_PAGES):
+            self.memory.invalidate((grequest.request, page_num))
+        self.memory.put(grequest.request, request_meta(grequest), 1)
+        for page_num, suggestions in enumerate(request_pages(grequest)):
+            self.memory.put((grequest.request, page_num), suggestions, len(suggestions))
+        self.index.add(grequest.request)
+        self.snapshot_stale.add(grequest.request)
+        self.pending_puts[grequest.request] = grequest
+        self.pending_puts.move_to_end(grequest.request)
+        self.touched.pop(grequest.request, None)
+        self.last_activity = time.time()
+        if len(self.pending_puts) >= WRITE_BEHIND_BATCH_MAX:
+            self.flush_event.set()
+
+    def record_put(self, grequest):
+        if self.trace != None:
+            pages = list(map(encode_suggestions, request_pages(grequest)))
+            self.trace.record(OP_PUT, grequest.request, request_size(grequest.request, pages))
+
+    def get_meta(self, query, trace=True):
+        # Returns the GRequest of query without its suggestions, see get_page
+        # Lookups repeating one already traced for the same caller pass trace=False
         with self.threadlock:
-            with sqlite3.connect(self.cache_path) as conn:
-                cur = conn.execute("""
-                    SELECT id, suggestions, cached_pages, max_pages, requested_time
-                    FROM requests
-                    WHERE request = ?;
-                """, (query,))
-                row = cur.fetchone()
-                if row == None:
-                    return None
-                id = row[0]
-                result = GRequest()
-                result.request = query
-                result.suggestions = list(map(lambda x: GSuggestion(x[0],x[1],x[2]),
-                                          json.loads(zlib.decompress(row[1]).decode('utf-8'))))
-                result.requested_pages = row[2]
-                result.max_pages = row[3]
-                result.requested_time = row[4]
-                conn.execute("""
-                    UPDATE requests SET last_retrieved = ? WHERE id = ?
-                """, (time.time(), id))
-                conn.commit()
+            self.last_activity = time.time()
+            self.touched[query] = self.last_activity
+            self.touched_hits[query] += 1
+            result = self.memory.get(query)
+            if result == None:
+                result = self.get_pending(query)
+                if result != None:
+                    result = request_meta(result)
+                elif self.snapshot != None and query not in self.snapshot_stale:
+                    result = self.snapshot.get_meta(query)
+                if result != None:
+                    self.memory.put(query, result, 1)
+            if result != None:
+                metrics.count("cache.hit")
+                if trace and self.trace != None:
+                    self.trace.record(OP_HIT, query)
                 return result
+        self.db_ready.wait()
+        with self.threadlock:
+            cur = self.conn.execute("""
+                SELECT cached_pages, max_pages, requested_time, size
+                FROM requests
+                WHERE request = ?;
+            """, (query,))
+            row = cur.fetchone()
+            if row == None:
+                self.touched.pop(query, None)
+                self.touched_hits.pop(query, None)
+                metrics.count("cache.miss")
+                if trace and self.trace != None:
+                    self.trace.record(OP_MISS, query)
+                return None
+            result = GRequest()
+            result.request = query
+            result.requested_pages = row[0]
+            result.max_pages = row[1]
+            result.requested_time = row[2]
+            self.memory.put(query, result, 1)
+            metrics.count("cache.hit")
+            if trace and self.trace != None:
+                self.trace.record(OP_HIT, query, row[3])
+            return result
+
+    def get_page(self, query, page_num):
+        # Returns the suggestions of a single page, only that page is decoded
+        key = (query, page_num)
+        with self.threadlock:
+            result = self.memory.get(key)
+            if result != None:
+                return result
+            pending = self.get_pending(query)
+            if pending != None:
+                result = page_view(pending.suggestions, page_num)
+            elif self.snapshot != None and query not in self.snapshot_stale:
+                result = self.snapshot.get_page(query, page_num)
+            if result != None:
+                self.memory.put(key, result, len(result))
+                return result
+        self.db_ready.wait()
+        with self.threadlock:
+            cur = self.conn.execute("""
+                SELECT pages.suggestions
+                FROM pages JOIN requests ON pages.request_id = requests.id
+                WHERE requests.request = ? AND pages.page_num = ?;
+            """, (query, page_num))
+            row = cur.fetchone()
+            if row == None:
+                return None
+            result = decode_suggestions(row[0])
+            self.memory.put(key, result, len(result))
+            return result
+
+    def get(self, query):
+        # Returns the whole GRequest, decoding every cached page
+        meta = self.get_meta(query)
+        if meta == None:
+            return None
+        result = request_meta(meta)
+        result.suggestions = []
+        for page_num in range(meta.requested_pages):
+            suggestions = self.get_page(query, page_num)
+            if suggestions == None:
+                return None
+            result.suggestions.extend(suggestions)
+        return result
+
+    def write_hot_snapshot(self):
+        # Saves the most recently used entries for the next activation, caller should hold threadlock
+        entries = read_entries(self.conn, SNAPSHOT_MAX_ENTRIES)
+        if self.snapshot != None:
+            self.snapshot.close()
+            self.snapshot = None
+        try:
+            write_snapshot(self.snapshot_path, entries)
+        except OSError as e:
+            metrics.log(LEVEL_WARNING, "Failed to write snapshot: {}", e)
 
     def close(self):
-        # Cleans up old entries
-        with sqlite3.connect(self.cache_path) as conn:
-            current_time = time.time()
-            conn.execute("""
-                DELETE FROM requests WHERE
-                    /* Remove super large requests */
-                    length(request) > 50 OR
-                    /* Remove entries older than 30 days */
-                    last_retrieved < (? - 2592000) OR
-                    /* Remove large entries older than 7 days */
-                    (length(request) > 20 AND last_retrieved < (? - 604800));
-            """, (current_time, current_time))
-            conn.commit()
\ No newline at end of file
+        # Flushes pending writes and snapshots the hot entries
+        # Old entries are evicted by maintain while idle, not here
+        self.closing = True
+        self.flush_event.set()
+        self.writer.join()
+        with self.threadlock:
+            self.memory.clear()
+            self.index.clear()
+            self.write_hot_snapshot()
+            self.conn.close()
+        self.flush_trace()
+        if self.trace != None:
+            self.trace.close()
@@ -2,30 +2,68 @@
 
 from keycodes import * # for VK_XXX constants
 from textService import *
-from input_methods.gcantonese.gretrieve import GWordRetrievalService
+from input_methods.gcantonese.gretrieve import acquire_retriever, release_retriever
+from input_methods.gcantonese.gschedule import PRIORITY_PREFETCH
+from input_methods.gcantonese.gmetrics import *
 import input_methods.gcantonese.gsymbols as gsymbols
 import concurrent.futures
 import os.path
 import time
 
 COMMAND_TOGGLE_LANGUAGE = 10
+PAGE_WAIT_TIMEOUT = 0.2
 
 class GCommit:
     def __init__(self, selected_suggestion, matched_string):
         self.selected_suggestion = selected_suggestion # Selected GSuggestion
         self.matched_string = matched_string
 
+class GCompositionState:
+    # Snapshot of the composition, a new one is pushed for every typed key or selection
+    # so going back restores the committed prefix, query and page without rebuilding them
+    def __init__(self, committing=(), committed="", buffer=""):
+        self.committing = committing # Tuple of GCommit
+        self.committed = committed # Words of committing joined together
+        self.buffer = buffer
+        # Use this to query retriever, the buffer alone if nothing is committed,
+        # otherwise in such format: "|{committing},{composition_buffer}"
+        if len(committing) == 0:
+            self.query = buffer
+        else:
+            self.query = "|{},{}".format(committed, buffer)
+        self.page = None # First GPage shown for this state
+
+    def type(self, c):
+        return GCompositionState(self.committing, self.committed, self.buffer + c)
+
+    def erase(self):
+        return GCompositionState(self.committing, self.committed, self.buffer[:-1])
+
+    def commit(self, selected):
+        commit = GCommit(selected, self.buffer[:selected.matched_length])
+        return GCompositionState(self.committing + (commit,), self.committed + selected.word,
+                                 self.buffer[selected.matched_length:])
+
+    def uncommit(self):
+        last_commit = self.committing[-1]
+        return GCompositionState(self.committing[:-1],
+                                 self.committed[:len(self.committed)-len(last_commit.selected_suggestion.word)],
+                                 last_commit.matched_string + self.buffer)
+
 class GCantoneseTextService(TextService):
     def __init__(self, client):
         TextService.__init__(self, client)
         self.icon_dir = os.path.abspath(os.path.dirname(__file__))
         self.retriever = None
-        self.committing = []
-        self.composition_buffer = ""
+        self.state = GCompositionState()
+        self.history = [] # States below self.state
+        self.pages = {} # First pages shown during this composition by query
         self.selected_page = None
         self.is_masking = False
         self.chinese_enabled = True
         self.last_pressed_key = 0
+        self.late_page = None
+        self.awaiting_page = None
 
     def onActivate(self):
         TextService.onActivate(self)
@@ -38,14 +76,14 @@ class GCantoneseTextService(TextService):
             )
             self.update_button_display()
         if self.retriever == None:
-            self.retriever = GWordRetrievalService()
+            self.retriever = acquire_retriever()
 
     def onDeactivate(self):
         TextService.onDeactivate(self)
         if self.client.isWindows8Above:
             self.removeButton("windows-mode-icon")
         if self.retriever != None:
-            self.retriever.close()
+            release_retriever(self.retriever)
             self.retriever = None
 
     def filterKeyDown(self, keyEvent):
@@ -64,6 +102,8 @@ class GCantoneseTextService(TextService):
         return True
 
     def filterKeyUp(self, keyEvent):
+        # The key down has already acted on the page that was on screen
+        self.apply_late_page()
         if keyEvent.keyCode == VK_SHIFT and \
            self.last_pressed_key == VK_SHIFT and \
            time.time() - self.last_pressed_time < 0.5:
@@ -89,12 +129,27 @@ class GCantoneseTextService(TextService):
         if self.client.isWindows8Above:
             self.changeButton("windows-mode-icon", icon=os.path.join(self.icon_dir, icon_name))
 
+    def push_state(self, state):
+        state.page = self.pages.get(state.query)
+        self.history.append(self.state)
+        self.state = state
+
+    def replace_state(self, state):
+        # Goes back to the previous state if it is the same composition
+        if len(self.history) > 0 and self.history[-1].query == state.query:
+            self.state = self.history.pop()
+        else:
+            state.page = self.pages.get(state.query)
+            self.state = state
+
+    def reset_state(self):
+        self.state = GCompositionState()
+        self.history.clear()
+        self.pages.clear()
+
     def update_composition(self):
-        composition = ""
-        for commit in self.committing:
-            composition += commit.selected_suggestion.word
-        composition += self.composition_buffer
-        self.setCompositionString(composition)
+        self.awaiting_page = None
+        self.setCompositionString(self.state.committed + self.state.buffer)
         self.setShowCandidates(False)
         self.is_masking = False
 
@@ -105,8 +160,7 @@ class GCantoneseTextService(TextService):
     def clear_composition(self):
         self.setShowCandidates(False)
         self.setCompositionString("")
-        self.committing.clear()
-        self.composition_buffer = ""
+        self.reset_state()
         self.is_masking = False
 
     def mask_composition(self):
@@ -115,14 +169,12 @@ class GCantoneseTextService(TextService):
         if self.candidateCursor < 0 or \
            self.candidateCursor >= len(self.selected_page.suggestions):
             return
-        composition = ""
-        for commit in self.committing:
-            composition += commit.selected_suggestion.word
         selected = self.selected_page.suggestions[self.candidateCursor]
-        composition += selected.word
-        leftovers = self.composition_buffer[selected.matched_length:]
+        composition = self.state.committed + selected.word
+        leftovers = self.state.buffer[selected.matched_length:]
         if len(leftovers) > 0:
-            self.retriever.register_input("|{},{}".format(composition, leftovers))
+            self.retriever.register_input("|{},{}".format(composition, leftovers),
+                                          PRIORITY_PREFETCH)
             composition += leftovers
         self.setCompositionString(composition)
         self.is_masking = True
@@ -134,8 +186,7 @@ class GCantoneseTextService(TextService):
         # composition buffer right after a word is being committed
         if forced:
             self.compositionString = ""
-            self.composition_buffer = ""
-            self.committing.clear()
+            self.reset_state()
             self.is_masking = False
 
     def on_candidate_select(self, index, select_next_page=False):
@@ -143,22 +194,22 @@ class GCantoneseTextService(TextService):
             return
         index = max(min(index, len(self.selected_page.suggestions) - 1), 0)
         selected = self.selected_page.suggestions[index]
-        matched_string = self.composition_buffer[:selected.matched_length]
-        self.composition_buffer = self.composition_buffer[selected.matched_length:]
-        self.committing.append(GCommit(selected, matched_string))
+        self.retriever.learn(self.get_input_query(), selected)
+        self.push_state(self.state.commit(selected))
         self.update_composition()
-        if len(self.composition_buffer) == 0:
+        if len(self.state.buffer) == 0:
             self.commit_composition()
         else:
             self.retriever.register_input(self.get_input_query())
             if select_next_page:
-                page = self.try_get_page(self.get_input_query(), 0)
+                page = self.state.page
+                if page == None:
+                    page = self.try_get_page(self.get_input_query(), 0)
                 if page != None:
-                    self.selected_page = page
-                    self.update_page()
-                    self.mask_composition()
+                    self.show_page(page)
                 else:
-                    print("[{}]: Page not ready!".format(ascii(self.get_input_query())))
+                    metrics.log(LEVEL_DEBUG, "[{!a}]: Page not ready!", self.get_input_query())
+                    metrics.count("page.not_ready")
 
     def update_page(self):
         if self.selected_page == None:
@@ -170,42 +221,86 @@ class GCantoneseTextService(TextService):
         self.setShowCandidates(True)
         self.setCandidateCursor(0)
 
-    # Returns composition buffer if no pending commit
-    # Use this to query retriever
-    # Otherwise return in such format: "|{committing},{composition_buffer}"
+    def show_page(self, page):
+        self.selected_page = page
+        self.update_page()
+        self.mask_composition()
+        self.retriever.observe_page(page.word, page.page_num)
+        # Provisional pages are replaced as soon as the real one arrives, never keep them
+        # Only the first page is kept, candidates always open on it
+        if page.page_num == 0 and not page.provisional and page.word == self.state.query:
+            self.state.page = page
+            self.pages[page.word] = page
+
+    # Use this to query retriever, see GCompositionState.query
     def get_input_query(self):
-        if len(self.committing) == 0:
-            return self.composition_buffer
-        else:
-            committing = "".join(map(lambda x:x.selected_suggestion.word, self.committing))
-            return "|{},{}".format(committing, self.composition_buffer)
+        return self.state.query
 
     def try_get_page(self, query, page_num):
-        for i in range(0,200):
-            page = self.retriever.get_page(query, page_num)
-            if page != None:
-                break
-            time.sleep(0.001)
+        # Waits for the page up to PAGE_WAIT_TIMEOUT, a page arriving later than
+        # that is shown on the next key event if the composition is unchanged
+        # A provisional page may be returned in the meantime, or instead of a page
+        # that cannot be retrieved at all, e.g. while the backend is down
+        self.awaiting_page = (query, page_num)
+        self.late_page = None
+        future = self.retriever.get_page_async(query, page_num)
+        # No point waiting for the network while it is known to be down
+        timeout = 0 if self.retriever.offline else PAGE_WAIT_TIMEOUT
+        try:
+            page = future.result(timeout=timeout)
+            self.awaiting_page = None
+        except concurrent.futures.TimeoutError:
+            future.add_done_callback(lambda f: self.on_late_page(query, page_num, f))
+            page = None
+        if page == None and page_num == 0:
+            # Candidates of a cached prefix or the local lexicon until the real page arrives
+            page = self.retriever.get_provisional_page(query)
+            if page == None:
+                page = self.retriever.get_local_page(query)
         return page
 
+    def on_late_page(self, query, page_num, future):
+        # Called from a retriever worker thread
+        if future.cancelled() or future.result() == None:
+            return
+        if self.awaiting_page == (query, page_num):
+            self.late_page = future.result()
+
+    def apply_late_page(self):
+        page = self.late_page
+        if page == None:
+            return
+        self.late_page = None
+        self.awaiting_page = None
+        if page.word != self.get_input_query() or not self.isComposing():
+            return
+        self.show_page(page)
+
     def try_switch_page(self, page_num):
         # retriever should handle page_num higher than page size
         page_num = max(0, page_num)
         query = self.selected_page.word
+        # The page asked for, a page past the cached ones is served clamped
+        self.retriever.observe_page(query, page_num)
         page = self.try_get_page(query, page_num)
         if page != None:
-            self.selected_page = page
-            self.update_page()
-            self.mask_composition()
+            self.show_page(page)
             return page.page_num
         return -1
 
     def onKeyDown(self, keyEvent):
+        with metrics.span("keydown", keyEvent.keyCode):
+            handled = self.handle_key_down(keyEvent)
+        # A late page is only swapped in after the key has been handled, so selecting
+        # keys act on the candidates the user saw, not on ones shown in the same event
+        self.apply_late_page()
+        return handled
+
+    def handle_key_down(self, keyEvent):
         if self.retriever == None:
-            print("Error: retriever not ready!!")
+            metrics.log(LEVEL_ERROR, "Error: retriever not ready!!")
         # Ctrl-C / Ctrl-V interrupts composition
         if keyEvent.keyCode != VK_CONTROL and keyEvent.isKeyDown(VK_CONTROL):
-            self.composition_buffer = ""
             self.commit_composition()
             return True
         # ESC cancels composition
@@ -225,14 +320,14 @@ class GCantoneseTextService(TextService):
                index < len(self.selected_page.suggestions):
                 self.on_candidate_select(index)
             return True
-        # Backspace reduces composition_buffer
+        # Backspace reduces composition buffer, or undoes the last selection
+        # Both go back to an earlier state with its page when there is one
         if keyEvent.keyCode == VK_BACK:
-            if len(self.composition_buffer) > 0:
+            if len(self.state.buffer) > 0:
                 if not self.is_masking:
-                    self.composition_buffer = self.composition_buffer[:-1]
-            elif len(self.committing) > 0:
-                last_commit = self.committing.pop()
-                self.composition_buffer = last_commit.matched_string
+                    self.replace_state(self.state.erase())
+            elif len(self.state.committing) > 0:
+                self.replace_state(self.state.uncommit())
             self.update_composition()
             return True
         # UP/DOWN keys for page switching
@@ -263,14 +358,15 @@ class GCantoneseTextService(TextService):
             if self.selected_page != None and self.showCandidates:
                 self.on_candidate_select(self.candidateCursor, select_next_page=True)
                 return True
-            if len(self.composition_buffer) > 0:
-                page = self.try_get_page(self.get_input_query(), 0)
+            if len(self.state.buffer) > 0:
+                page = self.state.page
+                if page == None:
+                    page = self.try_get_page(self.get_input_query(), 0)
                 if page != None:
-                    self.selected_page = page
-                    self.update_page()
-                    self.mask_composition()
+                    self.show_page(page)
                 else:
-                    print("[{}]: Page not ready!".format(ascii(self.get_input_query())))
+                    metrics.log(LEVEL_DEBUG, "[{!a}]: Page not ready!", self.get_input_query())
+                    metrics.count("page.not_ready")
                 return True
             self.commit_composition()
             return True
@@ -287,10 +383,9 @@ class GCantoneseTextService(TextService):
                 caps = not caps
             if keyEvent.isKeyToggled(VK_CAPITAL):
                 caps = not caps
-            if len(self.composition_buffer) < 50 and \
-               sum(len(commit.matched_string) for commit in self.committing) < 50:
-                self.composition_buffer = self.composition_buffer + \
-                                          chr(keyEvent.keyCode+(0 if caps else 32))
+            if len(self.state.buffer) < 50 and \
+               sum(len(commit.matched_string) for commit in self.state.committing) < 50:
+                self.push_state(self.state.type(chr(keyEvent.keyCode+(0 if caps else 32))))
             self.retriever.register_input(self.get_input_query())
             self.update_composition()
             return True
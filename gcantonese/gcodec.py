@@ -0,0 +1,209 @@
+#! python3
+
+import sys
+import json
+import time
+import zlib
+import random
+import sqlite3
+import tracemalloc
+from input_methods.gcantonese.gtypes import *
+
+# Suggestion page encoding, version 1:
+#   u8 format version, then zlib with SUGGESTION_ZDICT as preset dictionary over
+#   varint count, then per suggestion varint word length, varint annotation length
+#   and varint matched_length (lengths in characters), then all words and
+#   annotations as one utf-8 string
+# Blobs written before versioning are plain zlib-compressed JSON arrays of
+# [word, annotation, matched_length], they always start with the zlib header byte
+SUGGESTION_FORMAT_VERSION = 1
+
+# Preset dictionary corpus, least common first since zlib prefers the end of the
+# dictionary. Changing it breaks existing blobs, bump SUGGESTION_FORMAT_VERSION
+ZDICT_ANNOTATIONS = (
+    "nei5 si6 jau5 gwong2 maan6 gau6 zi6 co5 fan3 co3 baak3 cin1 syu1 jap6 "
+    "faat3 si1 ziu1 uk1 kei5 maai6 dou6 gei1 gau2 man4 man6 caa4 ce1 jyut6 "
+    "ji6 sei3 ng5 luk6 cat1 baat3 sap6 naam4 siu2 ze2 lai5 baai3 baa1 si2 "
+    "dei6 tit3 gaau3 leng3 zai2 neoi2 zung1 man2 jing1 hoeng1 dung1 maai4 "
+    "zau2 zan1 faai3 san1 sam1 saam1 gung1 gaa1 oi3 jam2 seoi2 haang4 nin4 "
+    "neoi5 faan1 hok6 si4 gaan3 din6 nou5 lou5 saang1 zok3 sin1 maa4 maa1 "
+    "baa4 sing1 kei4 ne1 faan6 gaai2 gaan1 gam1 ming4 tin1 zou2 maan5 gwok3 "
+    "gong2 cin2 ji5 ngaam1 hoi1 bin1 fong3 mou5 tai4 waa2 sau2 hou2 sik6 "
+    "maai5 ho2 kam4 jat6 pang4 ji3 zi1 hai6 mai6 mat1 teng1 soeng6 soeng2 "
+    "haa6 zung6 wui5 tung4 gei2 dak1 ting1 go3 do1 kei2 me1 gam3 waa6 tai2 "
+    "jiu3 san4 dim2 je5 m4 go2 lai4 zou6 daai6 jat1 zau6 ji4 ni1 di1 heoi3 "
+    "jan4 dou1 ze6 goi1 keoi5 zo2 hai2 ngo5 ge3"
+)
+ZDICT_WORDS = (
+    "妳是友廣慢舊字坐瞓錯百千萬輸入法師朝屋企賣道機九文問茶車月二"
+    "四五六七八十男小姐禮拜巴士地鐵瞓覺靚仔靚女中文英文香東埋度走"
+    "真快新心三工家愛飲水靚行年仔女返學時間電腦老師學生工作飲茶"
+    "先生媽媽爸爸星期呢飯解間今明天早晚國港生老錢以啱開返邊放工"
+    "冇問題問題電話手機好食少學買可先琴日返工朋友鍾意知道廣東話"
+    "係咪開心乜小時聽上想下中仲知會同幾得聽日邊度邊個幾多食飯屋企"
+    "咩咁日講話睇要早晨今日點解乜嘢香港唔係嗰食嚟做點大多一就而家"
+    "冇啲去嘢人都多謝唔該佢咗喺有個你好好你我係唔嘅"
+)
+
+SUGGESTION_ZDICT = (ZDICT_ANNOTATIONS + ZDICT_WORDS).encode("utf-8")
+
+def write_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def encode_suggestions(suggestions):
+    buffer = bytearray()
+    write_varint(buffer, len(suggestions))
+    text = []
+    for suggestion in suggestions:
+        write_varint(buffer, len(suggestion.word))
+        write_varint(buffer, len(suggestion.annotation))
+        write_varint(buffer, suggestion.matched_length)
+        text.append(suggestion.word)
+        text.append(suggestion.annotation)
+    buffer += "".join(text).encode("utf-8")
+    compressor = zlib.compressobj(9, zdict=SUGGESTION_ZDICT)
+    return bytes([SUGGESTION_FORMAT_VERSION]) + compressor.compress(bytes(buffer)) + compressor.flush()
+
+def decode_suggestions(blob):
+    if blob[0] != SUGGESTION_FORMAT_VERSION:
+        return decode_suggestions_json(blob)
+    decompressor = zlib.decompressobj(zdict=SUGGESTION_ZDICT)
+    data = decompressor.decompress(blob[1:])
+    count, position = read_varint(data, 0)
+    lengths = data[position:position+count*3]
+    if max(lengths, default=0) < 0x80:
+        # Every varint fits in one byte, the usual case for short words
+        position += count * 3
+    else:
+        lengths = []
+        for _ in range(count * 3):
+            value, position = read_varint(data, position)
+            lengths.append(value)
+    text = data[position:].decode("utf-8")
+    suggestions = []
+    offset = 0
+    for i in range(0, count * 3, 3):
+        word_end = offset + lengths[i]
+        annotation_end = word_end + lengths[i+1]
+        # Interned so the same words and annotations of different pages share one string
+        suggestions.append(GSuggestion(sys.intern(text[offset:word_end]),
+                                       sys.intern(text[word_end:annotation_end]), lengths[i+2]))
+        offset = annotation_end
+    return suggestions
+
+def is_current_format(blob):
+    return len(blob) > 0 and blob[0] == SUGGESTION_FORMAT_VERSION
+
+def encode_suggestions_json(suggestions):
+    return zlib.compress(json.dumps(
+            list(map(lambda x: (x.word, x.annotation, x.matched_length), suggestions)),
+            separators=(',', ':')
+        ).encode('utf-8')
+    )
+
+def decode_suggestions_json(blob):
+    return list(map(lambda x: GSuggestion(sys.intern(x[0]), sys.intern(x[1]), x[2]),
+                json.loads(zlib.decompress(blob).decode('utf-8'))))
+
+def benchmark(pages, rounds=20):
+    # Compares size and decode throughput of the JSON and binary page formats
+    results = {}
+    for name, encode, decode in (("json", encode_suggestions_json, decode_suggestions_json),
+                                 ("binary", encode_suggestions, decode_suggestions)):
+        blobs = list(map(encode, pages))
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for blob in blobs:
+                decode(blob)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "bytes": sum(map(len, blobs)),
+            "pages_per_second": len(blobs) * rounds / elapsed if elapsed > 0 else 0
+        }
+    return results
+
+def load_benchmark_pages(cache_path):
+    with sqlite3.connect(cache_path) as conn:
+        return list(map(lambda x: decode_suggestions(x[0]),
+                        conn.execute("SELECT suggestions FROM pages;")))
+
+def synthetic_requests(count, pages=2):
+    # Blobs of count requests made from the preset dictionary vocabulary, as a cache would hold them
+    rng = random.Random(0)
+    annotations = ZDICT_ANNOTATIONS.split(" ")
+    requests = []
+    for _ in range(count):
+        suggestions = []
+        for _ in range(pages * PAGE_SIZE):
+            length = rng.randint(1, 3)
+            start = rng.randrange(len(ZDICT_WORDS) - length)
+            suggestions.append(GSuggestion(ZDICT_WORDS[start:start+length],
+                                           " ".join(rng.sample(annotations, length)), length))
+        requests.append(list(map(lambda i: encode_suggestions(suggestions[i*PAGE_SIZE:(i+1)*PAGE_SIZE]),
+                                 range(pages))))
+    return requests
+
+def memory_benchmark(requests):
+    # Memory held by a working set of decoded requests and their pages, in the layout
+    # before __slots__, interning and page views, against the current one
+    class GPlainSuggestion:
+        def __init__(self, word, annotation, matched_length):
+            self.word = word
+            self.annotation = annotation
+            self.matched_length = matched_length
+    class GPlainRequest:
+        pass
+    def plain(blobs):
+        request = GPlainRequest()
+        # Every decode used to create its own strings
+        request.suggestions = [GPlainSuggestion(x.word.encode().decode(), x.annotation.encode().decode(),
+                                                x.matched_length)
+                               for blob in blobs for x in decode_suggestions(blob)]
+        pages = [request.suggestions[i*PAGE_SIZE:(i+1)*PAGE_SIZE] for i in range(len(blobs))]
+        return request, pages
+    def compact(blobs):
+        request = GRequest()
+        for blob in blobs:
+            request.suggestions.extend(decode_suggestions(blob))
+        return request, [page_view(request.suggestions, i) for i in range(len(blobs))]
+    results = {}
+    for name, build in (("plain", plain), ("compact", compact)):
+        tracemalloc.start()
+        working_set = list(map(build, requests))
+        results[name] = {
+            "bytes": tracemalloc.get_traced_memory()[0],
+            "bytes_per_request": tracemalloc.get_traced_memory()[0] / max(len(requests), 1)
+        }
+        tracemalloc.stop()
+        del working_set
+    return results
+
+if __name__ == "__main__":
+    # Usage: gcodec.py path/to/cache.sqlite
+    #        gcodec.py --memory [requests], for a synthetic working set, 10000 by default
+    if sys.argv[1] == "--memory":
+        requests = synthetic_requests(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+        print("{} requests".format(len(requests)))
+        for name, result in memory_benchmark(requests).items():
+            print("{:>7}: {:>10} bytes {:>8.0f} bytes/request".format(
+                name, result["bytes"], result["bytes_per_request"]))
+        sys.exit(0)
+    pages = load_benchmark_pages(sys.argv[1])
+    print("{} pages".format(len(pages)))
+    for name, result in benchmark(pages).items():
+        print("{:>6}: {:>10} bytes {:>12.0f} pages/s".format(
+            name, result["bytes"], result["pages_per_second"]))
@@ -0,0 +1,173 @@
+#! python3
+
+import os
+import re
+import sys
+import mmap
+import struct
+from input_methods.gcantonese.gtypes import *
+from input_methods.gcantonese.gmetrics import *
+from input_methods.gcantonese.gprefix import split_query
+
+LEXICON_MAGIC = b"GLEX"
+LEXICON_VERSION = 1
+LEXICON_HEADER = struct.Struct("<4sHI")
+LEXICON_OFFSET = struct.Struct("<I")
+LEXICON_FREQUENCY = struct.Struct("<H")
+
+# Lexicon file layout, all integers little endian:
+#   header: magic, version, record count
+#   index: u32 offset of each record, records sorted by key then frequency
+#   records: u8 length + key, u8 length + utf-8 word,
+#            u8 length + annotation, u16 frequency
+# Keys are toneless jyutping, so lookups work on what the user actually types
+
+def build_lexicon(source_path, target_path):
+    # Compiles a "jyutping<TAB>word<TAB>frequency" text file into the lexicon format
+    entries = []
+    with open(source_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) <= 0 or line.startswith("#"):
+                continue
+            jyutping, word, frequency = line.split("\t")
+            key = re.sub(r"\d", "", jyutping).encode("ascii")
+            annotation = re.sub(r"(\d)(?=.)", r"\1 ", jyutping).encode("ascii")
+            entries.append((key, -min(int(frequency), 0xffff), word.encode("utf-8"), annotation))
+    entries.sort()
+    records = bytearray()
+    offsets = []
+    base = LEXICON_HEADER.size + LEXICON_OFFSET.size * len(entries)
+    for key, frequency, word, annotation in entries:
+        offsets.append(base + len(records))
+        for field in (key, word, annotation):
+            records.append(len(field))
+            records += field
+        records += LEXICON_FREQUENCY.pack(-frequency)
+    temp_path = target_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(LEXICON_HEADER.pack(LEXICON_MAGIC, LEXICON_VERSION, len(entries)))
+        for offset in offsets:
+            f.write(LEXICON_OFFSET.pack(offset))
+        f.write(records)
+    os.replace(temp_path, target_path)
+
+def load_lexicon(source_path, target_path):
+    # Returns a GLexicon, recompiling the source if it changed, or None if unavailable
+    try:
+        if not os.path.exists(target_path) or \
+           os.path.getmtime(target_path) < os.path.getmtime(source_path):
+            build_lexicon(source_path, target_path)
+        return GLexicon(target_path)
+    except (OSError, ValueError) as e:
+        metrics.log(LEVEL_WARNING, "Lexicon unavailable: {}", e)
+        return None
+
+class GLexicon:
+    # Memory-mapped sorted lexicon, looked up by binary search over the offset index
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.count = LEXICON_HEADER.unpack_from(self.data, 0)
+        except (ValueError, struct.error):
+            self.file.close()
+            raise ValueError("{} is not a lexicon file".format(path))
+        if magic != LEXICON_MAGIC or version != LEXICON_VERSION:
+            self.close()
+            raise ValueError("{} has an unsupported lexicon version".format(path))
+
+    def offset_at(self, i):
+        return LEXICON_OFFSET.unpack_from(self.data, LEXICON_HEADER.size + LEXICON_OFFSET.size * i)[0]
+
+    def key_at(self, i):
+        offset = self.offset_at(i)
+        return self.data[offset+1:offset+1+self.data[offset]]
+
+    def record_at(self, i):
+        offset = self.offset_at(i)
+        fields = []
+        for _ in range(3):
+            length = self.data[offset]
+            fields.append(self.data[offset+1:offset+1+length])
+            offset += 1 + length
+        frequency = LEXICON_FREQUENCY.unpack_from(self.data, offset)[0]
+        return fields[1].decode("utf-8"), fields[2].decode("ascii"), frequency
+
+    def lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.key_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def lookup(self, key):
+        # Returns [(word, annotation, frequency)], most frequent first
+        key = key.encode("ascii", "ignore")
+        results = []
+        i = self.lower_bound(key)
+        while i < self.count and self.key_at(i) == key:
+            results.append(self.record_at(i))
+            i += 1
+        return results
+
+    def has_prefix(self, key):
+        key = key.encode("ascii", "ignore")
+        i = self.lower_bound(key)
+        return i < self.count and self.key_at(i).startswith(key)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class GLexiconEngine:
+    # Local candidate source producing suggestions shaped like a Google response
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+
+    def match(self, text, start):
+        # Lengths of lexicon keys starting at text[start:], longest first
+        lengths = []
+        for end in range(start + 1, len(text) + 1):
+            key = text[start:end]
+            if not self.lexicon.has_prefix(key):
+                break
+            if len(self.lexicon.lookup(key)) > 0:
+                lengths.append(end - start)
+        return list(reversed(lengths))
+
+    def suggest(self, input_str, num):
+        _, real_input = split_query(input_str)
+        text = real_input.lower()
+        suggestions = []
+        # Whole phrase from a greedy longest-match segmentation
+        words = []
+        annotations = []
+        position = 0
+        while position < len(text):
+            lengths = self.match(text, position)
+            if len(lengths) <= 0:
+                break
+            word, annotation, _ = self.lexicon.lookup(text[position:position+lengths[0]])[0]
+            words.append(word)
+            annotations.append(annotation)
+            position += lengths[0]
+        if len(words) > 1:
+            suggestions.append(GSuggestion("".join(words), " ".join(annotations), position))
+        # Single entries matching the start of the input, longest match first
+        for length in self.match(text, 0):
+            for word, annotation, _ in self.lexicon.lookup(text[:length]):
+                if all(x.word != word for x in suggestions):
+                    suggestions.append(GSuggestion(word, annotation, length))
+        if len(suggestions) <= 0:
+            suggestions.append(GSuggestion(real_input, "", len(real_input)))
+        return suggestions[:num]
+
+    def close(self):
+        self.lexicon.close()
+
+if __name__ == "__main__":
+    build_lexicon(sys.argv[1], sys.argv[2])
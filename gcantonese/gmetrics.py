@@ -0,0 +1,189 @@
+#! python3
+
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import collections
+import http.server
+
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+LEVEL_ERROR = 40
+
+LEVEL_NAMES = {"debug": LEVEL_DEBUG, "info": LEVEL_INFO, "warning": LEVEL_WARNING, "error": LEVEL_ERROR}
+
+# Upper bounds of histogram buckets in seconds, the last bucket is unbounded
+HISTOGRAM_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                     0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+TRACE_SPANS_MAX = 4096
+
+class GHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th sample
+        if self.count <= 0:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return HISTOGRAM_BUCKETS[i] if i < len(HISTOGRAM_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max
+        }
+
+class GSpan:
+    # Times a block into a histogram, also kept as a trace span when tracing is on
+    def __init__(self, metrics, name, detail):
+        self.metrics = metrics
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.perf_counter() - self.start
+        self.metrics.observe(self.name, duration)
+        if self.metrics.tracing:
+            self.metrics.trace(self.name, self.start, duration, self.detail)
+        return False
+
+class GMetrics:
+    # Process-wide counters, gauges, histograms and level-gated logging
+    # Log messages are only formatted when their level is enabled, pass the
+    # arguments instead of formatting them, using {!a} where ascii() is wanted
+    def __init__(self):
+        self.threadlock = threading.Lock()
+        self.level = LEVEL_NAMES.get(os.getenv("GCANTONESE_LOG_LEVEL", "warning").lower(),
+                                     LEVEL_WARNING)
+        self.tracing = os.getenv("GCANTONESE_TRACE", "") not in ("", "0")
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = collections.defaultdict(GHistogram)
+        self.spans = collections.deque(maxlen=TRACE_SPANS_MAX)
+        self.server = None
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        if level < self.level:
+            return
+        print(message.format(*args) if len(args) > 0 else message)
+
+    def count(self, name, n=1):
+        with self.threadlock:
+            self.counters[name] += n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.threadlock:
+            self.histograms[name].observe(value)
+
+    def span(self, name, detail=None):
+        return GSpan(self, name, detail)
+
+    def trace(self, name, start, duration, detail=None):
+        self.spans.append((name, start, duration, detail))
+
+    def counter(self, name):
+        with self.threadlock:
+            return self.counters[name]
+
+    def snapshot(self):
+        with self.threadlock:
+            result = {
+                "time": time.time(),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": dict(map(lambda x: (x[0], x[1].snapshot()), self.histograms.items()))
+            }
+            if self.tracing:
+                result["spans"] = list(map(lambda x: {
+                    "name": x[0], "start": x[1], "duration": x[2], "detail": x[3]
+                }, self.spans))
+        return result
+
+    def dump(self, path):
+        try:
+            with open(path, "w") as f:
+                json.dump(self.snapshot(), f, indent=2, default=str)
+        except OSError as e:
+            self.log(LEVEL_WARNING, "Failed to dump metrics: {}", e)
+
+    def reset(self):
+        with self.threadlock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.spans.clear()
+
+    def serve(self, port):
+        # Serves the snapshot as JSON on localhost for scraping
+        if self.server != None:
+            return
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot(), default=str).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        try:
+            self.server = http.server.HTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            self.log(LEVEL_WARNING, "Metrics endpoint unavailable: {}", e)
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def serve_from_env(self):
+        port = os.getenv("GCANTONESE_METRICS_PORT", "")
+        if port.isdigit():
+            self.serve(int(port))
+
+metrics = GMetrics()
+
+if __name__ == "__main__":
+    # Usage: gmetrics.py path/to/metrics.json, pretty prints a dump
+    with open(sys.argv[1]) as f:
+        dump = json.load(f)
+    for name, value in sorted(dump["counters"].items()):
+        print("{:<36}{:>12}".format(name, value))
+    for name, value in sorted(dump["gauges"].items()):
+        print("{:<36}{:>12}".format(name, value))
+    for name, h in sorted(dump["histograms"].items()):
+        print("{:<36}{:>12} p50 {:8.2f}ms p95 {:8.2f}ms p99 {:8.2f}ms".format(
+            name, h["count"], h["p50"] * 1000, h["p95"] * 1000, h["p99"] * 1000))
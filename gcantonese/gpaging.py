@@ -0,0 +1,112 @@
+#! python3
+
+import threading
+import collections
+from input_methods.gcantonese.gprefix import split_query
+
+PAGING_QUERY_SAMPLES = 8
+PAGING_QUERY_MIN_SAMPLES = 3
+PAGING_LENGTH_SAMPLES = 256
+PAGING_LENGTH_MIN_SAMPLES = 16
+PAGING_LENGTH_MAX = 12
+PAGING_MAX_QUERIES = 2000
+# A round trip the user waits for is worth this many pages of payload
+PAGING_ROUND_TRIP_COST = 2
+
+class GPagingModel:
+    # How deep users page through the candidates of a query, the deepest page of
+    # every visit is kept per query and per input length
+    # A visit starts when a query is shown and ends when another query is shown
+    def __init__(self):
+        self.threadlock = threading.Lock()
+        self.by_query = collections.OrderedDict()
+        self.by_length = collections.defaultdict(
+            lambda: collections.deque(maxlen=PAGING_LENGTH_SAMPLES))
+        self.visit_query = None
+        self.visit_depth = 0
+
+    def length_key(self, query):
+        return min(len(split_query(query)[1]), PAGING_LENGTH_MAX)
+
+    def observe(self, query, page_num):
+        # Called for every page shown to the user
+        with self.threadlock:
+            if query == self.visit_query:
+                self.visit_depth = max(self.visit_depth, page_num)
+                return
+            self.end_visit()
+            self.visit_query = query
+            self.visit_depth = page_num
+
+    def end_visit(self):
+        # Caller should hold threadlock
+        if self.visit_query == None:
+            return
+        samples = self.by_query.pop(self.visit_query, None)
+        if samples == None:
+            samples = collections.deque(maxlen=PAGING_QUERY_SAMPLES)
+        samples.append(self.visit_depth)
+        self.by_query[self.visit_query] = samples
+        while len(self.by_query) > PAGING_MAX_QUERIES:
+            self.by_query.popitem(last=False)
+        self.by_length[self.length_key(self.visit_query)].append(self.visit_depth)
+        self.visit_query = None
+
+    def depths(self, query):
+        # Deepest pages of past visits to query, or to queries of the same length
+        # when query itself has not been seen enough, None without enough data
+        with self.threadlock:
+            samples = self.by_query.get(query)
+            if samples != None and len(samples) >= PAGING_QUERY_MIN_SAMPLES:
+                return sorted(samples)
+            samples = self.by_length.get(self.length_key(query))
+            if samples != None and len(samples) >= PAGING_LENGTH_MIN_SAMPLES:
+                return sorted(samples)
+            return None
+
+    def initial_pages(self, query, default_pages, max_pages):
+        # Page count of the first request with the lowest expected cost over past visits
+        # Every page requested costs its payload, a visit browsing past half of them
+        # costs an escalation refetching more, and one browsing past all of them
+        # also costs a round trip the user waits for
+        depths = self.depths(query)
+        if depths == None:
+            return default_pages
+        best_pages = 1
+        best_cost = None
+        for pages in range(1, min(depths[-1] + 1, max_pages) + 1):
+            escalation = escalation_size(depths, pages, max_pages)
+            cost = pages
+            for depth in depths:
+                if escalates(depths, depth, pages):
+                    cost += escalation / len(depths)
+                if depth >= pages:
+                    cost += PAGING_ROUND_TRIP_COST / len(depths)
+            if best_cost == None or cost < best_cost:
+                best_pages = pages
+                best_cost = cost
+        return best_pages
+
+    def should_escalate(self, query, page_num, requested_pages):
+        # Whether showing page_num should fetch more pages in advance
+        depths = self.depths(query)
+        if depths == None:
+            return page_num >= requested_pages / 2
+        return escalates(depths, page_num, requested_pages)
+
+    def escalation_pages(self, query, requested_pages, max_pages):
+        # Pages to ask for once the user browses past half of requested_pages
+        depths = self.depths(query)
+        if depths == None:
+            return min(requested_pages * 2, max_pages)
+        return escalation_size(depths, requested_pages, max_pages)
+
+def escalates(depths, page_num, requested_pages):
+    # Past all of the cached pages, or past half of them when a past visit went further
+    if page_num >= requested_pages:
+        return True
+    return page_num >= requested_pages / 2 and depths[-1] >= requested_pages
+
+def escalation_size(depths, requested_pages, max_pages):
+    # At least double what is cached, enough for the deepest past visit in one go
+    return min(max(requested_pages * 2, depths[-1] + 1), max_pages)
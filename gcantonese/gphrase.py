@@ -0,0 +1,155 @@
+#! python3
+
+import time
+import sqlite3
+import threading
+from input_methods.gcantonese.gtypes import *
+from input_methods.gcantonese.gprefix import split_query
+from input_methods.gcantonese.gmetrics import *
+
+PHRASE_CONTEXT_LENGTH = 1
+PHRASE_HALF_LIFE = 30 * 86400
+PHRASE_PAGE_MAX = 3
+PHRASE_TRUST_COUNT = 3
+PHRASE_MAX_ENTRIES = 20000
+PHRASE_SAVE_BATCH = 32
+
+def phrase_keys(query):
+    # Keys of query, with the last committed characters as context and without
+    # Queries look like "|{committing},{real_input}"
+    context, real_input = split_query(query)
+    committed = context[1:-1]
+    if len(committed) <= 0:
+        return [("", real_input)]
+    return [(committed[-PHRASE_CONTEXT_LENGTH:], real_input), ("", real_input)]
+
+def phrase_score(count, last_used, now):
+    # Selection count decayed by how long ago the phrase was last selected
+    return count * 0.5 ** ((now - last_used) / PHRASE_HALF_LIFE)
+
+class GPhraseStore:
+    # Suggestions the user has selected, by what was typed and what was committed before
+    # Kept in memory as {(context, input): {word: [annotation, matched_length, count, last_used]}}
+    # and written back to sqlite in batches
+    def __init__(self, path):
+        self.path = path
+        self.threadlock = threading.Lock()
+        self.phrases = {}
+        self.dirty = set()
+        self.saving = False
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS phrases (
+                context TEXT NOT NULL,
+                input TEXT NOT NULL,
+                word TEXT NOT NULL,
+                annotation TEXT NOT NULL,
+                matched_length INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (context, input, word)
+            ) WITHOUT ROWID;
+        """)
+        for row in self.conn.execute("SELECT * FROM phrases;"):
+            self.phrases.setdefault((row[0], row[1]), {})[row[2]] = list(row[3:])
+
+    def learn(self, query, suggestion):
+        # Records that suggestion was selected while query was being composed
+        with self.threadlock:
+            now = time.time()
+            for key in phrase_keys(query):
+                entry = self.phrases.setdefault(key, {}).get(suggestion.word)
+                if entry == None:
+                    entry = [suggestion.annotation, suggestion.matched_length, 0, now]
+                    self.phrases[key][suggestion.word] = entry
+                entry[2] += 1
+                entry[3] = now
+                self.dirty.add((key, suggestion.word))
+            if len(self.dirty) < PHRASE_SAVE_BATCH or self.saving:
+                return
+            self.saving = True
+        threading.Thread(target=self.save, daemon=True).start()
+
+    def lookup(self, query):
+        # Returns [(GSuggestion, count)] of query, best first, context-specific ones ahead
+        results = []
+        seen = set()
+        with self.threadlock:
+            now = time.time()
+            for key in phrase_keys(query):
+                entries = self.phrases.get(key)
+                if entries == None:
+                    continue
+                ranked = sorted(entries.items(), key=lambda x: -phrase_score(x[1][2], x[1][3], now))
+                for word, (annotation, matched_length, count, _) in ranked:
+                    if word not in seen:
+                        seen.add(word)
+                        results.append((GSuggestion(word, annotation, matched_length), count))
+        return results
+
+    def is_trusted(self, query):
+        # Whether the best learned phrase has been picked often enough to skip the network
+        results = self.lookup(query)
+        return len(results) > 0 and results[0][1] >= PHRASE_TRUST_COUNT
+
+    def get_page(self, query):
+        # First page made of learned phrases alone, or None
+        results = self.lookup(query)
+        if len(results) <= 0:
+            return None
+        return GPage(query, 0, list(map(lambda x: x[0], results[:PAGE_SIZE])),
+                     provisional=results[0][1] < PHRASE_TRUST_COUNT)
+
+    def rerank(self, query, suggestions):
+        # Moves learned phrases on a first page to its front, the page keeps its words so
+        # that none of them goes missing or shows up again on the next page
+        results = self.lookup(query)[:PHRASE_PAGE_MAX]
+        if len(results) <= 0:
+            return suggestions
+        words = list(map(lambda x: x[0].word, results))
+        learned = sorted(filter(lambda x: x.word in words, suggestions),
+                         key=lambda x: words.index(x.word))
+        return learned + list(filter(lambda x: x.word not in words, suggestions))
+
+    def prune(self):
+        # Drops the lowest scored phrases over PHRASE_MAX_ENTRIES, caller should hold threadlock
+        entries = [(key, word, values) for key, words in self.phrases.items()
+                   for word, values in words.items()]
+        if len(entries) <= PHRASE_MAX_ENTRIES:
+            return []
+        now = time.time()
+        entries.sort(key=lambda x: phrase_score(x[2][2], x[2][3], now))
+        removed = entries[:len(entries)-PHRASE_MAX_ENTRIES]
+        for key, word, _ in removed:
+            del self.phrases[key][word]
+            if len(self.phrases[key]) <= 0:
+                del self.phrases[key]
+            self.dirty.discard((key, word))
+        return list(map(lambda x: (x[0][0], x[0][1], x[1]), removed))
+
+    def save(self):
+        with self.threadlock:
+            removed = self.prune()
+            rows = []
+            for key, word in self.dirty:
+                annotation, matched_length, count, last_used = self.phrases[key][word]
+                rows.append((key[0], key[1], word, annotation, matched_length, count, last_used))
+            self.dirty = set()
+            try:
+                with self.conn:
+                    self.conn.executemany("""
+                        INSERT OR REPLACE INTO phrases VALUES(?,?,?,?,?,?,?);
+                    """, rows)
+                    self.conn.executemany("""
+                        DELETE FROM phrases WHERE context = ? AND input = ? AND word = ?;
+                    """, removed)
+            except sqlite3.Error as e:
+                metrics.log(LEVEL_WARNING, "Failed to save phrases: {}", e)
+            self.saving = False
+
+    def close(self):
+        self.save()
+        with self.threadlock:
+            self.conn.close()
@@ -0,0 +1,101 @@
+#! python3
+
+import re
+import collections
+
+PREFETCH_CONTEXT_LENGTH = 2
+PREFETCH_MIN_COUNT = 2
+PREFETCH_MIN_PROBABILITY = 0.3
+
+# Extract real input from queries like "|{committing},{real_input}"
+def split_query(query):
+    real_input = re.sub(r"^\|.+,", "", query)
+    return query[:len(query)-len(real_input)], real_input
+
+class GPrefixIndex:
+    # Character trie over cached request keys
+    # Not thread safe by itself, callers should hold GCacheService.threadlock
+    TERMINAL = None
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, key):
+        node = self.root
+        for c in key:
+            node = node.setdefault(c, {})
+        if GPrefixIndex.TERMINAL not in node:
+            node[GPrefixIndex.TERMINAL] = True
+            self.size += 1
+
+    def remove(self, key):
+        path = []
+        node = self.root
+        for c in key:
+            if c not in node:
+                return
+            path.append((node, c))
+            node = node[c]
+        if node.pop(GPrefixIndex.TERMINAL, None) == None:
+            return
+        self.size -= 1
+        # Prunes branches left empty
+        for parent, c in reversed(path):
+            if len(parent[c]) > 0:
+                break
+            del parent[c]
+
+    def __contains__(self, key):
+        node = self.root
+        for c in key:
+            node = node.get(c)
+            if node == None:
+                return False
+        return GPrefixIndex.TERMINAL in node
+
+    def longest_prefix(self, query, min_length=1):
+        # Longest indexed key that is a proper prefix of query and at least min_length long
+        found = None
+        node = self.root
+        for i, c in enumerate(query[:-1]):
+            node = node.get(c)
+            if node == None:
+                break
+            if i + 1 >= min_length and GPrefixIndex.TERMINAL in node:
+                found = query[:i+1]
+        return found
+
+    def clear(self):
+        self.root = {}
+        self.size = 0
+
+class GTransitionModel:
+    # Counts which key tends to follow the last few typed characters
+    # Used to guess the next keystroke and fetch it before it is typed
+    def __init__(self, context_length=PREFETCH_CONTEXT_LENGTH):
+        self.context_length = context_length
+        self.transitions = collections.defaultdict(collections.Counter)
+
+    def context(self, query):
+        return split_query(query)[1][-self.context_length:]
+
+    def observe(self, previous, query):
+        if len(query) != len(previous) + 1 or not query.startswith(previous):
+            return
+        if len(split_query(previous)[1]) <= 0:
+            return
+        self.transitions[self.context(previous)][query[-1]] += 1
+
+    def predict(self, query, count):
+        # Returns up to count likely next queries, most likely first
+        counter = self.transitions.get(self.context(query))
+        if counter == None:
+            return []
+        total = sum(counter.values())
+        predictions = []
+        for c, n in counter.most_common(count):
+            if n < PREFETCH_MIN_COUNT or n / total < PREFETCH_MIN_PROBABILITY:
+                break
+            predictions.append(query + c)
+        return predictions
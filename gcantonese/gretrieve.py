@@ -2,79 +2,590 @@
 
 import os
 import re
+import sys
 import math
 import json
 import time
 import shutil
+import socket
+import collections
+import asyncio
 import threading
+import http.client
 import urllib.parse
-import urllib.request
 import concurrent.futures
 from input_methods.gcantonese.gcache import GCacheService
+from input_methods.gcantonese.gschedule import *
+from input_methods.gcantonese.gasync import GAsyncConnectionPool, GAsyncRequestScheduler
+from input_methods.gcantonese.gprefix import GTransitionModel, split_query
+from input_methods.gcantonese.glexicon import GLexiconEngine, load_lexicon
+from input_methods.gcantonese.gphrase import GPhraseStore
+from input_methods.gcantonese.gpaging import GPagingModel
 from input_methods.gcantonese.gtypes import *
+from input_methods.gcantonese.gmetrics import *
 
-PAGE_SIZE = 6
 REQUEST_URL = "https://inputtools.google.com/request"
 REQUEST_LANG = "yue-hant-t-i0-und"
+# Pages of the first request until there is browsing data, see GPagingModel
 REQUEST_PAGE_MIN = 2
 REQUEST_TRIAL_MAX = 7
+# Used until enough responses have been timed, see GLatencyTracker
+REQUEST_TIMEOUT = 1
+REQUEST_TIMEOUT_MIN = 0.25
+REQUEST_TIMEOUT_MAX = 3
+REQUEST_TIMEOUT_FACTOR = 3
+REQUEST_BACKOFF = 0.1
+REQUEST_BACKOFF_MIN = 0.05
+REQUEST_BACKOFF_MAX = 0.5
+LATENCY_WINDOW = 64
+LATENCY_MIN_SAMPLES = 8
+# Share of requests that may send a hedged duplicate, and how many may be saved up
+REQUEST_HEDGE_RATIO = 0.1
+REQUEST_HEDGE_BURST = 3
+REQUEST_POOL_SIZE = 4
+REQUEST_POOL_IDLE_TIMEOUT = 60
+REQUEST_CONCURRENCY_MAX = 8
+REQUEST_ASYNC_CONCURRENCY_MAX = 64
+# "thread" runs requests on blocking worker threads, "async" on a single event loop thread
+ENGINE_THREAD = "thread"
+ENGINE_ASYNC = "async"
+REQUEST_ENGINE = os.getenv("GCANTONESE_ENGINE", ENGINE_THREAD)
+PREFETCH_FANOUT = 2
+# How many leftover queries of partial matches on the first page are prefetched per response
+LEFTOVER_PREFETCH_FANOUT = 2
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 2
+BREAKER_RESET_TIMEOUT_MAX = 60
+NEGATIVE_CACHE_TTL = 5
+NEGATIVE_CACHE_MAX_ENTRIES = 256
+LEXICON_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexicon.txt")
+# Records cache lookups and writes to cache.trace for the gtrace simulator
+CACHE_TRACE = os.getenv("GCANTONESE_CACHE_TRACE", "") not in ("", "0")
+# Optional bundled cache entries built by gseed, loaded on first activation
+SEED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "seed.bin")
+
+class GConnectionPool:
+    # Keep-alive HTTP(S) connections shared by all request workers
+    # Idle connections are reused LIFO so the warmest socket is picked first
+    def __init__(self, url, max_size=REQUEST_POOL_SIZE, idle_timeout=REQUEST_POOL_IDLE_TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path if len(parts.path) > 0 else "/"
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.threadlock = threading.Lock()
+
+    def new_connection(self, timeout):
+        metrics.count("pool.created")
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def acquire(self, timeout):
+        # Returns (connection, reused)
+        expired = []
+        conn = None
+        with self.threadlock:
+            now = time.time()
+            while len(self.idle) > 0:
+                candidate, last_used = self.idle.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for candidate in expired:
+            candidate.close()
+        if conn == None:
+            return self.new_connection(timeout), False
+        metrics.count("pool.reused")
+        conn.timeout = timeout
+        if conn.sock != None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def release(self, conn):
+        with self.threadlock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def get(self, params_str, timeout=REQUEST_TIMEOUT):
+        # Sends a GET with the given query string and returns the response body
+        # A reused connection the server has already dropped is retried once on a fresh one
+        conn, reused = self.acquire(timeout)
+        while True:
+            try:
+                metrics.count("pool.requests")
+                conn.request("GET", "{}?{}".format(self.path, params_str))
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self.new_connection(timeout), False
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        if response.status != 200:
+            raise http.client.HTTPException("HTTP {} {}".format(response.status, response.reason))
+        return body
+
+    def close(self):
+        with self.threadlock:
+            idle = self.idle
+            self.idle = []
+        for conn, _ in idle:
+            conn.close()
+
+class GLatencyTracker:
+    # Rolling window of backend response times, the request timeout, retry backoff
+    # and hedging delay are derived from it
+    # Timed out requests count as taking the whole timeout so a slowing backend
+    # raises the timeout instead of timing out forever
+    def __init__(self, window=LATENCY_WINDOW, hedge_ratio=REQUEST_HEDGE_RATIO,
+                 hedge_burst=REQUEST_HEDGE_BURST):
+        self.samples = collections.deque(maxlen=window)
+        self.hedge_ratio = hedge_ratio
+        self.hedge_burst = hedge_burst
+        self.hedge_tokens = hedge_burst
+        self.threadlock = threading.Lock()
+
+    def observe(self, latency):
+        with self.threadlock:
+            self.samples.append(latency)
+
+    def percentile(self, p):
+        # None until there are enough samples
+        with self.threadlock:
+            if len(self.samples) < LATENCY_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    def timeout(self):
+        p99 = self.percentile(0.99)
+        if p99 == None:
+            return REQUEST_TIMEOUT
+        return max(REQUEST_TIMEOUT_MIN, min(p99 * REQUEST_TIMEOUT_FACTOR, REQUEST_TIMEOUT_MAX))
+
+    def backoff(self):
+        # Delay before the first retry, doubled for every retry after that
+        p50 = self.percentile(0.5)
+        if p50 == None:
+            return REQUEST_BACKOFF
+        return max(REQUEST_BACKOFF_MIN, min(p50, REQUEST_BACKOFF_MAX))
+
+    def hedge_delay(self):
+        # How long to wait for a response before sending a duplicate, None to never hedge
+        return self.percentile(0.95)
+
+    def start_request(self):
+        # Every request earns a fraction of a hedge
+        with self.threadlock:
+            self.hedge_tokens = min(self.hedge_tokens + self.hedge_ratio, self.hedge_burst)
+
+    def take_hedge(self):
+        with self.threadlock:
+            if self.hedge_tokens < 1:
+                return False
+            self.hedge_tokens -= 1
+            return True
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half-open"
+
+class GCircuitBreaker:
+    # Service-wide health of the backend, shared by all request workers
+    # Opens after consecutive failures so requests fail fast instead of retrying,
+    # then lets a single probe through once the reset timeout has passed
+    # The reset timeout doubles each time a probe fails
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT, reset_timeout_max=BREAKER_RESET_TIMEOUT_MAX):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.reset_timeout_max = reset_timeout_max
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_time = 0.0
+        self.threadlock = threading.Lock()
+
+    def set_state(self, state):
+        # Caller should hold threadlock
+        if state != self.state:
+            metrics.log(LEVEL_INFO, "Circuit breaker {} -> {}", self.state, state)
+            metrics.count("breaker." + state.replace("-", "_"))
+        self.state = state
+        metrics.gauge("breaker.state", state)
+
+    def is_open(self):
+        # True while requests would be rejected, ignoring a probe that may be due
+        with self.threadlock:
+            return self.state == BREAKER_HALF_OPEN or (self.state == BREAKER_OPEN and
+                   time.time() - self.opened_time < self.reset_timeout)
+
+    def allow(self):
+        # Whether a request may be sent now, at most one probe while half-open
+        with self.threadlock:
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_OPEN and time.time() - self.opened_time >= self.reset_timeout:
+                self.set_state(BREAKER_HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self):
+        with self.threadlock:
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+            self.set_state(BREAKER_CLOSED)
+
+    def record_failure(self):
+        with self.threadlock:
+            self.failures += 1
+            if self.state == BREAKER_HALF_OPEN:
+                self.reset_timeout = min(self.reset_timeout * 2, self.reset_timeout_max)
+            elif self.state == BREAKER_OPEN or self.failures < self.failure_threshold:
+                return
+            self.opened_time = time.time()
+            self.set_state(BREAKER_OPEN)
+
+class GFlight:
+    # One retrieval of a query shared by every caller asking for it
+    # Asking for more pages raises pages until the request starts, after that a
+    # successor flight supersedes this one and is started once this one ends,
+    # so that a query never has more than one request in the air
+    def __init__(self, pages, priority):
+        self.pages = pages
+        self.priority = priority
+        self.started = False
+        self.future = None
+        self.successor = None
 
 class GWordRetrievalService:
-    def __init__(self):
-        folder = os.path.join(os.getenv('APPDATA'), 'gcantonese')
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        self.cache = GCacheService(os.path.join(folder, "cache.sqlite"))
-        self.requesting = {}
+    def __init__(self, request_url=None, pool_size=REQUEST_POOL_SIZE, cache_dir=None, engine=None):
+        # Returns right away, the cache, pool and scheduler are set up on a background
+        # thread and callers block on self.ready only if they need them before that
+        if request_url == None:
+            request_url = REQUEST_URL
+        if cache_dir == None:
+            cache_dir = os.path.join(os.getenv('APPDATA'), 'gcantonese')
+        if engine == None:
+            engine = REQUEST_ENGINE
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.request_url = request_url
+        self.pool_size = pool_size
+        self.ready = threading.Event()
+        # In-flight GFlight of each query
+        self.flights = {}
+        self.waiters = {}
+        # Leftover queries being prefetched mapped to (query they follow, future),
+        # their own responses are not followed up
+        self.followups = {}
+        # Queries whose retrieval failed recently, mapped to when they may be retried
+        self.failed = {}
+        self.breaker = GCircuitBreaker()
+        self.latency = GLatencyTracker()
+        self.transitions = GTransitionModel()
+        self.paging = GPagingModel()
+        self.last_live = ""
+        self.lexicon_engine = None
+        self.lexicon_loaded = False
+        # Set when the last request gave up, local candidates are served right away
+        self.offline = False
+        # Bounds every request in the air, hedged duplicates included, see fetch
+        self.outbound = None
+        # Set by close, requests still running end quietly without touching the cache
+        self.closing = False
         self.threadlock = threading.Lock()
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=20)
+        threading.Thread(target=self.setup, daemon=True).start()
+
+    def setup(self):
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.cache = GCacheService(os.path.join(self.cache_dir, "cache.sqlite"),
+                                       seed_path=SEED_PATH,
+                                       trace_path=os.path.join(self.cache_dir, "cache.trace")
+                                                  if CACHE_TRACE else None)
+            self.phrases = GPhraseStore(os.path.join(self.cache_dir, "phrases.sqlite"))
+            if self.engine == ENGINE_ASYNC:
+                self.scheduler = GAsyncRequestScheduler(REQUEST_ASYNC_CONCURRENCY_MAX)
+                self.pool = GAsyncConnectionPool(self.request_url, self.scheduler.loop,
+                                                 self.pool_size, REQUEST_POOL_IDLE_TIMEOUT)
+                self.request_job = self.request_async
+            else:
+                self.pool = GConnectionPool(self.request_url, max_size=self.pool_size)
+                self.scheduler = GRequestScheduler(max_workers=REQUEST_CONCURRENCY_MAX)
+                self.outbound = threading.BoundedSemaphore(REQUEST_CONCURRENCY_MAX)
+                # Runs the requests that may be hedged, so the worker can wait on both
+                # Never busier than the outbound semaphore allows
+                self.hedge_executor = concurrent.futures.ThreadPoolExecutor(REQUEST_CONCURRENCY_MAX)
+                self.request_job = self.request
+            metrics.serve_from_env()
+        finally:
+            self.ready.set()
 
-    def request(self, input_str, pages):
-        print("[{}, {}]: Request scheduled!".format(ascii(input_str), pages))
+    def begin_request(self, input_str, flight):
+        # Returns (params_str, pages, requested_time), the page count is final from here on
         with self.threadlock:
             requested_time = time.time()
-            requesting_pages = self.requesting.get(input_str, 0)
-            if pages <= requesting_pages:
-                print("[{}, {}]: Request dropped for existing request".format(ascii(input_str), pages))
-                return
-            self.requesting[input_str] = pages
+            flight.started = True
+            pages = flight.pages
+        metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Request scheduled!", input_str, pages)
         request_num = PAGE_SIZE * pages
-        print("[{}, {}]: Requesting {} items from Google Input!".format(ascii(input_str), pages, request_num))
+        metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Requesting {} items from Google Input!", input_str, pages, request_num)
+        metrics.count("request.started")
         params = {}
         params['text'] = input_str
         params['itc'] = REQUEST_LANG
         params['num'] = request_num
         params['ie'] = 'utf-8'
         params['oe'] = 'utf-8'
-        params_str = urllib.parse.urlencode(params, encoding='utf-8')
+        return urllib.parse.urlencode(params, encoding='utf-8'), pages, requested_time
+
+    def end_flight(self, input_str, flight):
+        # Caller should hold threadlock, a superseding flight is left alone
+        if self.flights.get(input_str) is flight:
+            del self.flights[input_str]
+
+    def parse_response(self, input_str, pages, body):
+        # Returns the decoded response, or None if it reports an error or is not shaped
+        # like ["SUCCESS", [[text, [words], [], {"annotation": [...], ...}]]]
+        # A malformed body counts as a failed trial, it must not escape as an exception
+        try:
+            response = json.loads(body.decode('utf-8'))
+            status = response[0]
+            if status == "SUCCESS":
+                words = response[1][0][1]
+                word_info = response[1][0][3]
+                if not isinstance(words, list) or not isinstance(word_info, dict):
+                    raise TypeError("unexpected suggestion list")
+                if len(words) > 0 and len(word_info['annotation']) < len(words):
+                    raise IndexError("fewer annotations than suggestions")
+                if 'matched_length' in word_info and len(word_info['matched_length']) < len(words):
+                    raise IndexError("fewer matched lengths than suggestions")
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            metrics.log(LEVEL_WARNING, "[{!a}, {}]: Word suggestion retrieval error: {}",
+                        input_str, pages, e)
+            return None
+        if status != "SUCCESS":
+            metrics.log(LEVEL_WARNING, "[{!a}, {}]: Google input tools reported an error: {}",
+                        input_str, pages, status)
+            return None
+        return response
+
+    def reject_request(self, input_str, flight):
+        metrics.log(LEVEL_INFO, "[{!a}, {}]: Circuit breaker open, failing fast", input_str, flight.pages)
+        metrics.count("request.rejected")
+        with self.threadlock:
+            self.end_flight(input_str, flight)
+            self.offline = True
+        self.notify_waiters(input_str)
+
+    def drop_request(self, input_str, flight):
+        # close is tearing down the pool and the cache, the outcome of the request
+        # is neither stored nor held against the backend
+        metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Closing, request dropped", input_str, flight.pages)
+        with self.threadlock:
+            self.end_flight(input_str, flight)
+
+    def fail_trial(self, input_str, flight, trials, backoff):
+        # Returns True when the request should give up
+        metrics.count("request.error")
+        self.breaker.record_failure()
+        pages = flight.pages
+        if trials >= REQUEST_TRIAL_MAX:
+            metrics.log(LEVEL_ERROR, "[{!a}, {}]: Retrieval failed after {} retries.",
+                        input_str, pages, trials)
+            metrics.count("request.failed")
+            with self.threadlock:
+                self.end_flight(input_str, flight)
+                self.offline = True
+                self.add_failed(input_str)
+            self.notify_waiters(input_str)
+            return True
+        metrics.log(LEVEL_INFO, "[{!a}, {}]: Retrying in {} seconds...", input_str, pages, backoff)
+        metrics.count("request.retry")
+        return False
+
+    def request(self, input_str, flight):
+        params_str, pages, requested_time = self.begin_request(input_str, flight)
         trials = 0
-        backoff = 0.1
+        backoff = self.latency.backoff()
         while True:
-            print("[{}, {}]: Request trail {}...".format(ascii(input_str), pages, trials))
-            successful = False
+            if not self.breaker.allow():
+                self.reject_request(input_str, flight)
+                return
+            metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Request trial {}...", input_str, pages, trials)
+            response = None
             try:
-                response = urllib.request.urlopen("{}?{}".format(REQUEST_URL, params_str), timeout=1)
-                response = json.loads(response.read().decode('utf-8'), encoding='utf-8')
-                if response[0] != "SUCCESS":
-                    print("[{}, {}]:".format(ascii(input_str), pages),
-                          "Google input tools reported an error: {}".format(response[0]))
-                else:
-                    successful = True
-            except (ValueError, urllib.error.URLError) as e:
-                print("[{}, {}]: Word suggestion retrieval error: {}".format(ascii(input_str), pages, e))
-            if not successful:
-                if trials >= REQUEST_TRIAL_MAX:
-                    print("[{}, {}]: Retrieval failed after {} retries.".format(ascii(input_str), pages, trials))
-                    with self.threadlock:
-                        self.requesting.pop(input_str, 0)
+                with metrics.span("request.latency"):
+                    response = self.parse_response(input_str, pages, self.fetch(params_str))
+            except (OSError, http.client.HTTPException) as e:
+                metrics.log(LEVEL_WARNING, "[{!a}, {}]: Word suggestion retrieval error: {}",
+                            input_str, pages, e)
+            if self.closing:
+                self.drop_request(input_str, flight)
+                return
+            if response != None:
+                break
+            if self.fail_trial(input_str, flight, trials, backoff):
+                return
+            time.sleep(backoff)
+            backoff *= 2
+            trials += 1
+        self.complete_request(input_str, flight, response, requested_time)
+
+    async def request_async(self, input_str, flight):
+        # Same as request, for the event loop engine
+        params_str, pages, requested_time = self.begin_request(input_str, flight)
+        trials = 0
+        backoff = self.latency.backoff()
+        try:
+            while True:
+                if not self.breaker.allow():
+                    self.reject_request(input_str, flight)
+                    return
+                metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Request trial {}...", input_str, pages, trials)
+                response = None
+                try:
+                    with metrics.span("request.latency"):
+                        body = await self.fetch_async(params_str)
+                    response = self.parse_response(input_str, pages, body)
+                except (OSError, http.client.HTTPException) as e:
+                    metrics.log(LEVEL_WARNING, "[{!a}, {}]: Word suggestion retrieval error: {}",
+                                input_str, pages, e)
+                if self.closing:
+                    self.drop_request(input_str, flight)
                     return
-                print("[{}, {}]: Retrying in {backoff} seconds...".format(ascii(input_str), pages))
-                time.sleep(backoff)
+                if response != None:
+                    break
+                if self.fail_trial(input_str, flight, trials, backoff):
+                    return
+                await asyncio.sleep(backoff)
                 backoff *= 2
                 trials += 1
-            else:
-                break
-        print("[{}, {}]: Got a response! forging GRequest...".format(ascii(input_str), pages))
+        except asyncio.CancelledError:
+            with self.threadlock:
+                self.end_flight(input_str, flight)
+            raise
+        self.complete_request(input_str, flight, response, requested_time)
+
+    def timed_get(self, params_str, timeout):
+        # Caller has acquired an outbound permit, given back once the request is over,
+        # which for a losing hedge is when its answer is dropped
+        try:
+            start = time.perf_counter()
+            try:
+                body = self.pool.get(params_str, timeout)
+            except socket.timeout:
+                self.latency.observe(timeout)
+                raise
+            self.latency.observe(time.perf_counter() - start)
+            return body
+        finally:
+            self.outbound.release()
+
+    def fetch(self, params_str):
+        # Returns the response body, sending a hedged duplicate when the first
+        # request is slower than the usual p95, whichever answers first wins
+        # Primaries wait for an outbound permit, a hedge is only sent if one is free
+        self.latency.start_request()
+        timeout = self.latency.timeout()
+        delay = self.latency.hedge_delay()
+        self.outbound.acquire()
+        if delay == None or delay >= timeout:
+            return self.timed_get(params_str, timeout)
+        primary = self.hedge_executor.submit(self.timed_get, params_str, timeout)
+        try:
+            return primary.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self.outbound.acquire(blocking=False):
+            metrics.count("request.hedge_skipped")
+            return primary.result()
+        if not self.latency.take_hedge():
+            self.outbound.release()
+            return primary.result()
+        metrics.count("request.hedged")
+        hedge = self.hedge_executor.submit(self.timed_get, params_str, timeout)
+        pending = {primary, hedge}
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() == None:
+                    # A blocking request already sent cannot be stopped, its answer is dropped
+                    for other in pending:
+                        other.cancel()
+                    if future is hedge:
+                        metrics.count("request.hedge_won")
+                    return future.result()
+        return primary.result()
+
+    async def timed_get_async(self, params_str, timeout):
+        async with self.outbound:
+            start = time.perf_counter()
+            try:
+                body = await self.pool.get(params_str, timeout)
+            except socket.timeout:
+                self.latency.observe(timeout)
+                raise
+            self.latency.observe(time.perf_counter() - start)
+            return body
+
+    async def fetch_async(self, params_str):
+        # Same as fetch, the losing request is cancelled and its connection closed
+        if self.outbound == None:
+            # Created on the loop thread so that it belongs to the loop
+            self.outbound = asyncio.Semaphore(REQUEST_ASYNC_CONCURRENCY_MAX)
+        self.latency.start_request()
+        timeout = self.latency.timeout()
+        delay = self.latency.hedge_delay()
+        if delay == None or delay >= timeout:
+            return await self.timed_get_async(params_str, timeout)
+        primary = asyncio.ensure_future(self.timed_get_async(params_str, timeout))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if len(done) > 0:
+                return await primary
+            if self.outbound.locked():
+                metrics.count("request.hedge_skipped")
+                return await primary
+            if not self.latency.take_hedge():
+                return await primary
+            metrics.count("request.hedged")
+            hedge = asyncio.ensure_future(self.timed_get_async(params_str, timeout))
+            pending.add(hedge)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() == None:
+                        if task is hedge:
+                            metrics.count("request.hedge_won")
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def complete_request(self, input_str, flight, response, requested_time):
+        self.breaker.record_success()
+        pages = flight.pages
+        self.offline = False
+        metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Got a response! forging GRequest...", input_str, pages)
+        request_num = PAGE_SIZE * pages
         # Extract real input from queries like "|{committing},{real_input}"
         real_input = re.sub(r"^\|.+,", "", input_str)
         word_suggestions = response[1][0][1]
@@ -96,50 +607,350 @@ class GWordRetrievalService:
                     matched_length = word_info['matched_length'][i]
                 else:
                     matched_length = len(real_input)
-                grequest.suggestions.append(GSuggestion(word, annotation,
+                grequest.suggestions.append(GSuggestion(sys.intern(word), sys.intern(annotation),
                                                         matched_length))
         grequest.requested_time = requested_time
-        print("[{}, {}]: Saving to cache...".format(ascii(input_str), pages))
+        metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Saving to cache...", input_str, pages)
         with self.threadlock:
-            cached = self.cache.get(input_str)
-            if cached != None:
-                if cached.requested_time > grequest.requested_time:
-                    print("[{}, {}]: Skipping save, cache is newer!".format(ascii(input_str), pages))
-                    self.requesting.pop(input_str, 0)
-                    return
-            self.cache.put(grequest)
-            self.requesting.pop(input_str, 0)
-        print("[{}, {}]: Request completed!".format(ascii(input_str), pages))
+            if self.closing:
+                # The cache may be closed already, see close
+                self.end_flight(input_str, flight)
+                return
+            skipped = not self.cache.put_if_newer(grequest)
+            if skipped:
+                metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Skipping save, cache is newer!", input_str, pages)
+            self.end_flight(input_str, flight)
+            # Only the composition on screen is followed up, not prefetches or leftovers
+            follow_up = input_str not in self.followups and input_str == self.scheduler.live_key
+        self.notify_waiters(input_str)
+        if follow_up:
+            self.prefetch_leftovers(input_str, grequest.suggestions[:PAGE_SIZE])
+        metrics.observe("request.total", time.time() - requested_time)
+        metrics.count("request.completed")
+        if not skipped:
+            metrics.log(LEVEL_DEBUG, "[{!a}, {}]: Request completed!", input_str, pages)
+
+    def add_failed(self, input_str):
+        # Caller should hold threadlock
+        if len(self.failed) >= NEGATIVE_CACHE_MAX_ENTRIES:
+            now = time.time()
+            self.failed = dict(filter(lambda x: x[1] > now, self.failed.items()))
+            if len(self.failed) >= NEGATIVE_CACHE_MAX_ENTRIES:
+                self.failed.pop(next(iter(self.failed)))
+        self.failed[input_str] = time.time() + NEGATIVE_CACHE_TTL
+
+    def should_request(self, input_str):
+        # False while the backend is known to be down or input_str failed moments ago
+        if self.breaker.is_open():
+            return False
+        with self.threadlock:
+            retry_time = self.failed.get(input_str)
+            if retry_time == None:
+                return True
+            if time.time() < retry_time:
+                metrics.count("request.negative_cached")
+                return False
+            del self.failed[input_str]
+            return True
+
+    def notify_waiters(self, input_str):
+        # Wakes up callers waiting on input_str, pages not yet available resolve to None
+        with self.threadlock:
+            waiters = self.waiters.pop(input_str, [])
+            self.followups.pop(input_str, None)
+        for page_num, future in waiters:
+            if not future.done():
+                future.set_result(self.get_page(input_str, page_num, register=False))
+
+    def submit(self, input_str, pages, priority):
+        # Joins the flight of input_str when it asks for as many pages, or has not started
+        # yet and can still ask for more, otherwise starts a new one, chained after the
+        # running one if any
+        # Returns the future of the flight, None while a chained flight waits for its turn
+        with self.threadlock:
+            flight = self.flights.get(input_str)
+            if flight != None and (pages <= flight.pages or not flight.started):
+                if pages > flight.pages:
+                    flight.pages = pages
+                    metrics.count("request.upgraded")
+                else:
+                    metrics.count("request.joined")
+                flight.priority = min(flight.priority, priority)
+                return flight.future
+            running = flight
+            flight = GFlight(pages, priority)
+            self.flights[input_str] = flight
+            if running != None:
+                running.successor = flight
+                metrics.count("request.chained")
+                return None
+            flight.future = self.scheduler.submit(input_str, priority, self.request_job, input_str, flight)
+        metrics.gauge("scheduler.queue_depth", self.scheduler.queue_depth())
+        flight.future.add_done_callback(lambda f: self.finish_flight(input_str, flight, f))
+        return flight.future
+
+    def finish_flight(self, input_str, flight, future):
+        # Requests end their flight themselves, unless cancelled because the live
+        # composition superseded them or stopped by an unexpected error
+        if future.cancelled() or future.exception() != None:
+            # While closing, the hedge executor and the pool refuse new requests
+            if not future.cancelled() and not self.closing:
+                # Also resolves a circuit breaker probe the request may have been
+                metrics.log(LEVEL_ERROR, "[{!a}, {}]: Request stopped by an unexpected error: {!r}",
+                            input_str, flight.pages, future.exception())
+                self.breaker.record_failure()
+            with self.threadlock:
+                self.end_flight(input_str, flight)
+            self.notify_waiters(input_str)
+        self.start_successor(input_str, flight)
+
+    def start_successor(self, input_str, flight):
+        # Starts the flight chained after flight, unless the response of flight already
+        # holds what it asks for or the request would fail fast
+        with self.threadlock:
+            successor = flight.successor
+            flight.successor = None
+            if self.closing:
+                successor = None
+        if successor == None:
+            return
+        cached = self.cache.get_meta(input_str, trace=False)
+        if (cached != None and (cached.requested_pages >= successor.pages or \
+                                cached.requested_pages == cached.max_pages)) or \
+           not self.should_request(input_str):
+            metrics.count("request.chain_dropped")
+            with self.threadlock:
+                self.end_flight(input_str, successor)
+            self.notify_waiters(input_str)
+            return
+        with self.threadlock:
+            successor.future = self.scheduler.submit(input_str, successor.priority, self.request_job,
+                                                     input_str, successor)
+        metrics.gauge("scheduler.queue_depth", self.scheduler.queue_depth())
+        successor.future.add_done_callback(lambda f: self.finish_flight(input_str, successor, f))
 
-    def register_input(self, input_str):
+    def register_input(self, input_str, priority=PRIORITY_LIVE, trace=True):
+        # trace=False when the caller has already traced its cache lookup, see GAccessTrace
         if len(input_str) <= 0:
             return
-        cached = self.cache.get(input_str)
+        self.ready.wait()
+        if priority == PRIORITY_LIVE:
+            self.scheduler.set_live(input_str)
+            self.cancel_followups(input_str)
+            self.prefetch_next(input_str)
+        cached = self.cache.get_meta(input_str, trace)
         if cached != None:
             if cached.requested_pages == cached.max_pages or \
-               cached.requested_pages >= REQUEST_PAGE_MIN:
+               cached.requested_pages >= self.initial_pages(input_str):
                 return
-        if input_str in self.requesting:
+        if not self.should_request(input_str):
+            return
+        if priority != PRIORITY_ESCALATE and self.phrases.is_trusted(input_str):
+            # The first page is served from learned phrases, later pages are escalated
+            metrics.count("phrase.skipped")
             return
-        self.executor.submit(self.request, input_str, REQUEST_PAGE_MIN)
+        self.submit(input_str, self.initial_pages(input_str), priority)
+
+    def prefetch_next(self, input_str):
+        # Speculatively requests the most likely next keystrokes of the live composition
+        self.transitions.observe(self.last_live, input_str)
+        self.last_live = input_str
+        for prediction in self.transitions.predict(input_str, PREFETCH_FANOUT):
+            if not self.cache.is_request_in_cache(prediction) and self.should_request(prediction):
+                self.submit(prediction, self.initial_pages(prediction), PRIORITY_PREFETCH)
+
+    def prefetch_leftovers(self, input_str, suggestions):
+        # Suggestions matching only the start of the input are likely to be selected,
+        # after which the query becomes "|{committed + word},{leftover}"
+        context, real_input = split_query(input_str)
+        committed = context[1:-1]
+        queries = []
+        for suggestion in self.phrases.rerank(input_str, suggestions):
+            if len(queries) >= LEFTOVER_PREFETCH_FANOUT:
+                break
+            if suggestion.matched_length <= 0 or suggestion.matched_length >= len(real_input):
+                continue
+            query = "|{},{}".format(committed + suggestion.word, real_input[suggestion.matched_length:])
+            if query not in queries:
+                queries.append(query)
+        for query in queries:
+            if self.cache.is_request_in_cache(query) or not self.should_request(query):
+                continue
+            with self.threadlock:
+                if query in self.flights or query in self.followups:
+                    continue
+                self.followups[query] = (input_str, None)
+            metrics.count("prefetch.leftover")
+            future = self.submit(query, self.initial_pages(query), PRIORITY_PREFETCH)
+            with self.threadlock:
+                if query in self.followups:
+                    self.followups[query] = (input_str, future)
+
+    def cancel_followups(self, live_str):
+        # Leftovers of a composition the user has typed past are not going to be selected,
+        # queued ones are dropped while running ones are left to finish
+        # A leftover that became the live composition is followed up like any other
+        with self.threadlock:
+            self.followups.pop(live_str, None)
+            futures = [future for parent, future in self.followups.values()
+                       if parent != live_str and future != None]
+        for future in futures:
+            future.cancel()
+
+    def initial_pages(self, input_str):
+        return self.paging.initial_pages(input_str, REQUEST_PAGE_MIN, REQUEST_MAX_PAGES)
 
-    def get_page(self, input_str, page):
-        cached = self.cache.get(input_str)
+    def observe_page(self, input_str, page_num):
+        # Called for every page the user asks for, drives the page counts of later requests
+        # page_num is the page asked for, which may be past the pages cached so far
+        self.paging.observe(input_str, page_num)
+
+    def get_page(self, input_str, page, register=True):
+        # register=False for internal re-lookups, which are left out of the cache trace
+        self.ready.wait()
+        cached = self.cache.get_meta(input_str, register)
+        suggestions = None
         if cached != None and cached.requested_pages > 0:
-            if page >= cached.requested_pages / 2 and \
-               cached.requested_pages < cached.max_pages:
-                # Request more pages in advance
-                requesting_pages = min(cached.requested_pages * 2, cached.max_pages)
-                self.executor.submit(self.request, input_str, requesting_pages)
             page_num = max(min(page, cached.requested_pages - 1), 0)
-            suggestions = cached.suggestions[page_num*PAGE_SIZE:(page_num+1)*PAGE_SIZE]
-            page = GPage(input_str, page_num, suggestions)
-            return page
+            suggestions = self.cache.get_page(input_str, page_num)
+        if suggestions != None:
+            if self.paging.should_escalate(input_str, page, cached.requested_pages) and \
+               cached.requested_pages < cached.max_pages and self.should_request(input_str):
+                # Request more pages in advance
+                requesting_pages = self.paging.escalation_pages(input_str, cached.requested_pages,
+                                                                cached.max_pages)
+                self.submit(input_str, requesting_pages, PRIORITY_ESCALATE)
+            if page_num == 0:
+                suggestions = self.phrases.rerank(input_str, suggestions)
+            return GPage(input_str, page_num, suggestions)
         else:
+            if page == 0:
+                learned = self.phrases.get_page(input_str)
+                if learned != None and not learned.provisional:
+                    return learned
             # Page not ready
-            self.register_input(input_str) # Trigger word retrieval just in case
+            if register:
+                # Trigger word retrieval just in case
+                self.register_input(input_str, PRIORITY_LIVE if page == 0 else PRIORITY_ESCALATE,
+                                    trace=False)
+            return None
+
+    def learn(self, input_str, suggestion):
+        # Called when suggestion is selected while input_str is being composed
+        self.ready.wait()
+        self.phrases.learn(input_str, suggestion)
+
+    def get_provisional_page(self, input_str):
+        # Serves candidates from the longest cached prefix while input_str is in flight
+        # Only suggestions within the prefix are kept, the rest of input_str is left over
+        # Phrases learned for input_str itself come first
+        self.ready.wait()
+        learned = self.phrases.get_page(input_str)
+        if learned != None:
+            return learned
+        prefix = self.cache.longest_cached_prefix(input_str)
+        if prefix == None:
+            return None
+        cached = self.cache.get_page(prefix, 0)
+        if cached == None:
+            return None
+        prefix_length = len(split_query(prefix)[1])
+        suggestions = list(filter(lambda x: 0 < x.matched_length <= prefix_length, cached))
+        if len(suggestions) <= 0:
+            return None
+        return GPage(input_str, 0, suggestions, provisional=True)
+
+    def get_local_page(self, input_str):
+        # Candidates from the offline lexicon, available without any network
+        self.ready.wait()
+        with self.threadlock:
+            if not self.lexicon_loaded:
+                self.lexicon_loaded = True
+                lexicon = load_lexicon(LEXICON_SOURCE, os.path.join(self.cache_dir, "lexicon.bin"))
+                if lexicon != None:
+                    self.lexicon_engine = GLexiconEngine(lexicon)
+            engine = self.lexicon_engine
+        if engine == None or len(input_str) <= 0:
+            return None
+        return GPage(input_str, 0, engine.suggest(input_str, PAGE_SIZE), provisional=True)
+
+    def get_page_async(self, input_str, page):
+        # Returns a future resolving to the GPage as soon as a request worker stores it,
+        # or to None if the retrieval fails or is not attempted
+        future = concurrent.futures.Future()
+        if len(input_str) <= 0:
+            future.set_result(None)
+            return future
+        with self.threadlock:
+            self.waiters.setdefault(input_str, []).append((page, future))
+        result = self.get_page(input_str, page)
+        with self.threadlock:
+            # Without a flight nobody is going to notify the waiter, e.g. when the
+            # circuit breaker or the negative cache declined the request
+            pending = result == None and input_str in self.flights
+            if not pending:
+                waiters = self.waiters.get(input_str, [])
+                if (page, future) in waiters:
+                    waiters.remove((page, future))
+                    if len(waiters) <= 0:
+                        self.waiters.pop(input_str, None)
+        if not pending and not future.done():
+            if result == None:
+                # The flight may have stored the page and ended in the meantime
+                result = self.get_page(input_str, page, register=False)
+            future.set_result(result)
+        return future
+
+    def wait_page(self, input_str, page, timeout):
+        # Blocks for at most timeout seconds, returns None if the page is not ready by then
+        try:
+            return self.get_page_async(input_str, page).result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
             return None
 
     def close(self):
-        self.executor.shutdown(wait=False)
+        self.ready.wait()
+        with self.threadlock:
+            self.closing = True
+            waiters = self.waiters
+            self.waiters = {}
+        for _, futures in waiters.items():
+            for _, future in futures:
+                future.cancel()
+        # Running requests drop their outcome from here on, see drop_request
+        # The event loop engine closes its idle connections on the loop before it stops
+        self.pool.close()
+        self.scheduler.shutdown()
+        if self.engine != ENGINE_ASYNC:
+            self.hedge_executor.shutdown(wait=False)
         self.cache.close()
+        self.phrases.close()
+        metrics.dump(os.path.join(self.cache_dir, "metrics.json"))
+        if self.lexicon_engine != None:
+            self.lexicon_engine.close()
+
+# PIME creates a text service per client, they all share one retrieval service
+# so the workers, in-flight requests and cache are not duplicated per client
+shared_retriever = None
+shared_retriever_refs = 0
+shared_retriever_lock = threading.Lock()
+
+def acquire_retriever():
+    # Returns the process-wide GWordRetrievalService, created on first use
+    global shared_retriever, shared_retriever_refs
+    with shared_retriever_lock:
+        if shared_retriever == None:
+            shared_retriever = GWordRetrievalService()
+        shared_retriever_refs += 1
+        return shared_retriever
+
+def release_retriever(retriever):
+    # Closes the shared service when the last text service using it lets go
+    global shared_retriever, shared_retriever_refs
+    with shared_retriever_lock:
+        if retriever is shared_retriever:
+            shared_retriever_refs -= 1
+            if shared_retriever_refs > 0:
+                return
+            shared_retriever = None
+        retriever.close()
@@ -0,0 +1,110 @@
+#! python3
+
+import heapq
+import itertools
+import threading
+import concurrent.futures
+
+PRIORITY_LIVE = 0
+PRIORITY_ESCALATE = 1
+PRIORITY_PREFETCH = 2
+
+class GScheduledJob:
+    def __init__(self, priority, seq, key, fn, args):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.future = concurrent.futures.Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class GRequestScheduler:
+    # Runs request jobs on a fixed number of workers, most urgent first
+    # The job keyed by the live composition always runs ahead of prefetches and
+    # page escalations, and queued jobs for prefixes the user has typed past
+    # are cancelled
+    def __init__(self, max_workers):
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.live_key = None
+        self.closing = False
+        self.workers = []
+        self.start(max_workers)
+
+    def start(self, max_workers):
+        for i in range(max_workers):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def wake(self):
+        # A job was queued, caller should hold condition
+        self.condition.notify()
+
+    def submit(self, key, priority, fn, *args):
+        with self.condition:
+            if key == self.live_key:
+                priority = PRIORITY_LIVE
+            job = GScheduledJob(priority, next(self.counter), key, fn, args)
+            if self.closing:
+                job.future.cancel()
+                return job.future
+            heapq.heappush(self.queue, job)
+            self.wake()
+        return job.future
+
+    def set_live(self, key):
+        cancelled = []
+        with self.condition:
+            if key == self.live_key:
+                return
+            self.live_key = key
+            queue = []
+            for job in self.queue:
+                if job.key == key:
+                    job.priority = PRIORITY_LIVE
+                elif key.startswith(job.key):
+                    # Superseded prefix, the user has already typed past it
+                    cancelled.append(job)
+                    continue
+                elif job.priority == PRIORITY_LIVE:
+                    job.priority = PRIORITY_PREFETCH
+                queue.append(job)
+            heapq.heapify(queue)
+            self.queue = queue
+        for job in cancelled:
+            job.future.cancel()
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def work(self):
+        while True:
+            with self.condition:
+                while len(self.queue) <= 0 and not self.closing:
+                    self.condition.wait()
+                if self.closing:
+                    return
+                job = heapq.heappop(self.queue)
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = job.fn(*job.args)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+
+    def shutdown(self):
+        with self.condition:
+            self.closing = True
+            queue = self.queue
+            self.queue = []
+            self.condition.notify_all()
+        for job in queue:
+            job.future.cancel()
@@ -0,0 +1,143 @@
+#! python3
+
+# Cache seeding tool
+# Fetches a list of queries through GWordRetrievalService and writes them to a seed
+# file, which is a hot snapshot file (see gsnapshot) that a new cache imports in one
+# transaction on first activation when it is bundled as seed.bin next to gretrieve
+#
+# Usage: python gseed.py build [--queries queries.txt] [--url URL] [--rate 20]
+#                              [--pages 2] [--engine async] seed.bin
+#        python gseed.py export cache.sqlite seed.bin
+#        python gseed.py import seed.bin cache.sqlite
+
+import os
+import re
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import concurrent.futures
+# Run as a script next to gbench, which makes the package importable outside PIME
+from gbench import install_package
+
+def default_queries(lexicon_path):
+    # Every toneless syllable of the lexicon, then every pair of adjacent syllables
+    syllables = []
+    bigrams = []
+    with open(lexicon_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) <= 0 or line.startswith("#"):
+                continue
+            keys = re.findall(r"[a-z]+(?=\d)", line.split("\t")[0])
+            syllables.extend(keys)
+            bigrams.extend(map(lambda i: keys[i] + keys[i+1], range(len(keys) - 1)))
+    return list(dict.fromkeys(syllables + bigrams))
+
+def load_queries(path):
+    with open(path, encoding="utf-8") as f:
+        return list(dict.fromkeys(filter(lambda x: len(x) > 0, map(str.strip, f))))
+
+def build(queries, output_path, url, rate, pages, engine=None):
+    # Returns the queries that could not be fetched
+    from input_methods.gcantonese.gretrieve import GWordRetrievalService
+    from input_methods.gcantonese.gschedule import PRIORITY_PREFETCH
+    from input_methods.gcantonese.gcache import request_meta, request_pages
+    from input_methods.gcantonese.gcodec import encode_suggestions
+    from input_methods.gcantonese.gsnapshot import write_snapshot
+    cache_dir = tempfile.mkdtemp()
+    service = GWordRetrievalService(request_url=url, cache_dir=cache_dir, engine=engine)
+    try:
+        service.ready.wait()
+        # Submissions are spaced 1/rate apart, the scheduler bounds how many run at once
+        futures = []
+        next_time = time.perf_counter()
+        for i, query in enumerate(queries):
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_time = max(next_time, time.perf_counter()) + 1 / rate
+            futures.append(service.submit(query, pages, PRIORITY_PREFETCH))
+            if (i + 1) % 100 == 0:
+                print("{}/{} submitted".format(i + 1, len(queries)))
+        concurrent.futures.wait(futures)
+        entries = []
+        failed = []
+        for query in queries:
+            grequest = service.cache.get(query)
+            if grequest == None:
+                failed.append(query)
+                continue
+            entries.append((request_meta(grequest),
+                            list(map(encode_suggestions, request_pages(grequest)))))
+        write_snapshot(output_path, entries)
+        return failed
+    finally:
+        service.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def export(cache_path, output_path):
+    # Writes every request of an existing cache to a seed file, returns the entry count
+    from input_methods.gcantonese.gcache import read_entries
+    from input_methods.gcantonese.gsnapshot import write_snapshot
+    with sqlite3.connect(cache_path) as conn:
+        entries = read_entries(conn)
+    write_snapshot(output_path, entries)
+    return len(entries)
+
+def import_seed(seed_path, cache_path):
+    # Returns the number of imported requests
+    from input_methods.gcantonese.gcache import GCacheService
+    cache = GCacheService(cache_path)
+    try:
+        cache.db_ready.wait()
+        conn = cache.connect()
+        try:
+            return len(cache.import_seed(conn, seed_path))
+        finally:
+            conn.close()
+    finally:
+        cache.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Builds, exports and imports cache seed files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="fetch queries into a seed file")
+    build_parser.add_argument("output")
+    build_parser.add_argument("--queries", help="text file with one query per line, "
+                                                "defaults to the syllables and bigrams of lexicon.txt")
+    build_parser.add_argument("--url", help="Input Tools endpoint, defaults to gretrieve.REQUEST_URL")
+    build_parser.add_argument("--rate", type=float, default=20, help="requests started per second")
+    build_parser.add_argument("--pages", type=int, default=2, help="pages fetched per query")
+    build_parser.add_argument("--engine", choices=["thread", "async"], help="retrieval engine, see gretrieve")
+    export_parser = commands.add_parser("export", help="write an existing cache to a seed file")
+    export_parser.add_argument("cache")
+    export_parser.add_argument("output")
+    import_parser = commands.add_parser("import", help="load a seed file into a cache")
+    import_parser.add_argument("seed")
+    import_parser.add_argument("cache")
+    args = parser.parse_args(argv)
+    install_package()
+    if args.command == "build":
+        if args.queries != None:
+            queries = load_queries(args.queries)
+        else:
+            queries = default_queries(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                   "lexicon.txt"))
+        print("Fetching {} queries".format(len(queries)))
+        failed = build(queries, args.output, args.url, args.rate, args.pages, args.engine)
+        print("Wrote {} entries to {}, {} failed".format(
+            len(queries) - len(failed), args.output, len(failed)))
+        for query in failed:
+            print("  {}".format(query))
+        return 1 if len(failed) > 0 else 0
+    if args.command == "export":
+        print("Wrote {} entries to {}".format(export(args.cache, args.output), args.output))
+        return 0
+    print("Imported {} entries into {}".format(import_seed(args.seed, args.cache), args.cache))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
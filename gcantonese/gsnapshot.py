@@ -0,0 +1,145 @@
+#! python3
+
+import os
+import mmap
+import struct
+from input_methods.gcantonese.gtypes import *
+from input_methods.gcantonese.gmetrics import *
+from input_methods.gcantonese.gcodec import decode_suggestions
+
+SNAPSHOT_MAGIC = b"GSNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHI")
+SNAPSHOT_OFFSET = struct.Struct("<I")
+SNAPSHOT_KEY = struct.Struct("<H")
+SNAPSHOT_META = struct.Struct("<HHdH")
+SNAPSHOT_PAGE = struct.Struct("<I")
+
+# Snapshot file layout, all integers little endian:
+#   header: magic, version, entry count
+#   index: u32 offset of each entry, entries sorted by utf-8 request key
+#   entries: u16 length + key, u16 cached pages, u16 max pages,
+#            f64 requested time, u16 page count, then per page
+#            u32 length + encoded page exactly as stored in sqlite
+
+def write_snapshot(path, entries):
+    # entries: iterable of (GRequest without suggestions, [encoded page blobs])
+    entries = sorted(map(lambda x: (x[0].request.encode("utf-8"), x[0], x[1]), entries),
+                     key=lambda x: x[0])
+    records = bytearray()
+    offsets = []
+    base = SNAPSHOT_HEADER.size + SNAPSHOT_OFFSET.size * len(entries)
+    for key, meta, pages in entries:
+        offsets.append(base + len(records))
+        records += SNAPSHOT_KEY.pack(len(key))
+        records += key
+        records += SNAPSHOT_META.pack(meta.requested_pages, meta.max_pages,
+                                      meta.requested_time, len(pages))
+        for page in pages:
+            records += SNAPSHOT_PAGE.pack(len(page))
+            records += page
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(entries)))
+        for offset in offsets:
+            f.write(SNAPSHOT_OFFSET.pack(offset))
+        f.write(records)
+    os.replace(temp_path, path)
+
+class GHotSnapshot:
+    # Read-only view of a snapshot file, pages are decoded straight out of the mapping
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.count = SNAPSHOT_HEADER.unpack_from(self.data, 0)
+        except (ValueError, struct.error):
+            self.file.close()
+            raise ValueError("{} is not a snapshot file".format(path))
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError("{} has an unsupported snapshot version".format(path))
+        self.view = memoryview(self.data)
+
+    @staticmethod
+    def open(path):
+        # Returns None when there is no usable snapshot
+        if not os.path.exists(path):
+            return None
+        try:
+            return GHotSnapshot(path)
+        except (OSError, ValueError) as e:
+            metrics.log(LEVEL_WARNING, "Snapshot unavailable: {}", e)
+            return None
+
+    def offset_at(self, i):
+        return SNAPSHOT_OFFSET.unpack_from(self.data, SNAPSHOT_HEADER.size + SNAPSHOT_OFFSET.size * i)[0]
+
+    def key_at(self, offset):
+        length = SNAPSHOT_KEY.unpack_from(self.data, offset)[0]
+        start = offset + SNAPSHOT_KEY.size
+        return self.data[start:start+length], start + length
+
+    def find(self, query):
+        # Returns the offset of the entry's metadata, or None
+        key = query.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            found, meta_offset = self.key_at(self.offset_at(mid))
+            if found < key:
+                low = mid + 1
+            elif found > key:
+                high = mid
+            else:
+                return meta_offset
+        return None
+
+    def __contains__(self, query):
+        return self.find(query) != None
+
+    def get_meta(self, query):
+        offset = self.find(query)
+        if offset == None:
+            return None
+        result = GRequest()
+        result.request = query
+        result.requested_pages, result.max_pages, result.requested_time, _ = \
+            SNAPSHOT_META.unpack_from(self.data, offset)
+        return result
+
+    def get_page(self, query, page_num):
+        offset = self.find(query)
+        if offset == None:
+            return None
+        page_count = SNAPSHOT_META.unpack_from(self.data, offset)[3]
+        if page_num < 0 or page_num >= page_count:
+            return None
+        offset += SNAPSHOT_META.size
+        for _ in range(page_num):
+            offset += SNAPSHOT_PAGE.size + SNAPSHOT_PAGE.unpack_from(self.data, offset)[0]
+        length = SNAPSHOT_PAGE.unpack_from(self.data, offset)[0]
+        offset += SNAPSHOT_PAGE.size
+        return decode_suggestions(self.view[offset:offset+length])
+
+    def entries(self):
+        # Yields (GRequest without suggestions, [encoded page blobs]) of every entry in key order
+        for i in range(self.count):
+            key, offset = self.key_at(self.offset_at(i))
+            meta = GRequest()
+            meta.request = key.decode("utf-8")
+            meta.requested_pages, meta.max_pages, meta.requested_time, page_count = \
+                SNAPSHOT_META.unpack_from(self.data, offset)
+            offset += SNAPSHOT_META.size
+            pages = []
+            for _ in range(page_count):
+                length = SNAPSHOT_PAGE.unpack_from(self.data, offset)[0]
+                offset += SNAPSHOT_PAGE.size
+                pages.append(self.data[offset:offset+length])
+                offset += length
+            yield meta, pages
+
+    def close(self):
+        self.view.release()
+        self.data.close()
+        self.file.close()
@@ -0,0 +1,329 @@
+#! python3
+
+# Cache access traces and an offline eviction policy simulator
+# GAccessTrace appends every lookup made for a caller and every write to a compact log when
+# GCANTONESE_CACHE_TRACE is set, see gretrieve. Running this module replays such a log
+# against candidate policies at several capacities
+#
+# Usage: python gtrace.py [--capacity 256K,1M,4M,8M] [--policy lru,lfu,size,gcache]
+#                         [--ttl 1d,7d,30d] [--warmup 0.1] cache.trace
+
+import sys
+import time
+import heapq
+import struct
+import argparse
+import threading
+
+TRACE_MAGIC = b"GTRC"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sH")
+TRACE_OP = struct.Struct("<B")
+TRACE_SESSION = struct.Struct("<d")
+TRACE_KEY = struct.Struct("<H")
+TRACE_EVENT = struct.Struct("<IIi")
+TRACE_BUFFER_MAX = 64 * 1024
+TRACE_MAX_BYTES = 64 * 1024 * 1024
+
+OP_KEY = 0
+OP_HIT = 1
+OP_MISS = 2
+OP_PUT = 3
+OP_SESSION = 4
+
+# Trace file layout, all integers little endian:
+#   header: magic, version, written once when the file is created
+#   records: u8 op, then
+#     session: f64 start time, key ids restart from 0
+#     key: u16 length + utf-8 key, takes the next key id
+#     hit, miss, put: u32 key id, u32 size in bytes or 0 when unknown,
+#                     i32 milliseconds since the session started
+
+class GAccessTrace:
+    # Append-only recorder, events are buffered and written by flush
+    # A trace that cannot be written stops recording rather than failing lookups
+    def __init__(self, path, max_bytes=TRACE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.threadlock = threading.Lock()
+        self.keys = {}
+        self.sizes = {}
+        self.buffer = bytearray()
+        self.file = open(path, "ab")
+        self.written = self.file.tell()
+        if self.written <= 0:
+            self.buffer += TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION)
+        self.start = time.time()
+        self.buffer += TRACE_OP.pack(OP_SESSION) + TRACE_SESSION.pack(self.start)
+
+    def record(self, op, key, size=0):
+        # size 0 means the last size recorded for key, if any
+        with self.threadlock:
+            if self.file == None:
+                return
+            key_id = self.keys.get(key)
+            if key_id == None:
+                key_id = len(self.keys)
+                self.keys[key] = key_id
+                encoded = key.encode("utf-8")
+                self.buffer += TRACE_OP.pack(OP_KEY) + TRACE_KEY.pack(len(encoded)) + encoded
+            if size > 0:
+                self.sizes[key_id] = size
+            else:
+                size = self.sizes.get(key_id, 0)
+            self.buffer += TRACE_OP.pack(op) + TRACE_EVENT.pack(
+                key_id, size, int((time.time() - self.start) * 1000))
+            full = len(self.buffer) >= TRACE_BUFFER_MAX
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.threadlock:
+            if self.file == None or len(self.buffer) <= 0:
+                return
+            buffer = self.buffer
+            self.buffer = bytearray()
+            try:
+                if self.written + len(buffer) > self.max_bytes:
+                    raise OSError("trace is full at {} bytes".format(self.written))
+                self.file.write(buffer)
+                self.file.flush()
+                self.written += len(buffer)
+            except OSError:
+                self.file.close()
+                self.file = None
+                raise
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self.threadlock:
+                if self.file != None:
+                    self.file.close()
+                    self.file = None
+
+def read_trace(path):
+    # Yields (op, key, size, time) of every hit, miss and put in the file
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError("{} is not a trace file".format(path))
+    magic, version = TRACE_HEADER.unpack_from(data, 0)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError("{} is not a supported trace file".format(path))
+    offset = TRACE_HEADER.size
+    keys = []
+    start = 0.0
+    # A record cut short by a crash ends the trace
+    while offset + TRACE_OP.size <= len(data):
+        op = TRACE_OP.unpack_from(data, offset)[0]
+        offset += TRACE_OP.size
+        if op == OP_SESSION:
+            if offset + TRACE_SESSION.size > len(data):
+                return
+            start = TRACE_SESSION.unpack_from(data, offset)[0]
+            offset += TRACE_SESSION.size
+            keys = []
+        elif op == OP_KEY:
+            if offset + TRACE_KEY.size > len(data):
+                return
+            length = TRACE_KEY.unpack_from(data, offset)[0]
+            offset += TRACE_KEY.size
+            if offset + length > len(data):
+                return
+            keys.append(data[offset:offset+length].decode("utf-8"))
+            offset += length
+        elif op in (OP_HIT, OP_MISS, OP_PUT):
+            if offset + TRACE_EVENT.size > len(data):
+                return
+            key_id, size, elapsed = TRACE_EVENT.unpack_from(data, offset)
+            offset += TRACE_EVENT.size
+            yield op, keys[key_id], size, start + elapsed / 1000
+        else:
+            raise ValueError("Unknown trace record {} at offset {}".format(op, offset - 1))
+
+def fill_sizes(events):
+    # Lookups served from memory are traced before their size is known,
+    # they take the key's size from elsewhere in the trace, or the median size
+    sizes = {}
+    for _, key, size, _ in events:
+        if size > 0:
+            sizes.setdefault(key, size)
+    known = sorted(sizes.values())
+    median = known[len(known) // 2] if len(known) > 0 else 1
+    return list(map(lambda x: (x[0], x[1], x[2] if x[2] > 0 else sizes.get(x[1], median), x[3]),
+                    events))
+
+class GSimulatedCache:
+    # Byte-budgeted cache evicting the entry with the lowest priority first
+    # Entries are [size, hits, last_access, expiry], stale heap items are skipped
+    def __init__(self, name, capacity, priority, ttl=None):
+        self.name = name
+        self.capacity = capacity # None for no byte budget
+        self.priority = priority # (entry, simulator) -> sort key
+        self.ttl = ttl # (key) -> seconds an entry lives past its last access, None to keep it
+        self.entries = {}
+        self.heap = []
+        self.expiries = []
+        self.stored = 0
+        self.clock = 0.0 # Priority of the last evicted entry, used by size-aware policies
+
+    def push(self, key, entry):
+        heapq.heappush(self.heap, (self.priority(entry, self), entry[2], key, id(entry), entry[1]))
+
+    def expire(self, now):
+        while len(self.expiries) > 0 and self.expiries[0][0] <= now:
+            expiry, key, entry_id = heapq.heappop(self.expiries)
+            entry = self.entries.get(key)
+            if entry != None and id(entry) == entry_id and entry[3] == expiry:
+                self.remove(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.stored -= entry[0]
+
+    def touch(self, key, entry, now):
+        entry[1] += 1
+        entry[2] = now
+        if self.ttl != None:
+            ttl = self.ttl(key)
+            entry[3] = now + ttl if ttl != None else None
+            if entry[3] != None:
+                heapq.heappush(self.expiries, (entry[3], key, id(entry)))
+        if self.capacity != None:
+            self.push(key, entry)
+
+    def get(self, key, now):
+        entry = self.entries.get(key)
+        if entry == None:
+            return False
+        self.touch(key, entry, now)
+        return True
+
+    def put(self, key, size, now):
+        if self.ttl != None and self.ttl(key) == 0:
+            return
+        entry = self.entries.get(key)
+        if entry == None:
+            entry = [size, 0, now, None]
+            self.entries[key] = entry
+        else:
+            self.stored -= entry[0]
+            entry[0] = size
+        self.stored += size
+        self.touch(key, entry, now)
+        while self.capacity != None and self.stored > self.capacity and len(self.heap) > 0:
+            priority, last, victim, entry_id, hits = heapq.heappop(self.heap)
+            entry = self.entries.get(victim)
+            # Only the newest heap item of an entry counts
+            if entry == None or id(entry) != entry_id or entry[1] != hits or entry[2] != last:
+                continue
+            self.clock = priority
+            self.remove(victim)
+
+def simulate(events, cache, warmup):
+    # Lookups missing the simulated cache fill it, writes always do
+    # Returns the report of the lookups after the first warmup share of events
+    counted_from = int(len(events) * warmup)
+    hits = 0
+    lookups = 0
+    fetched = 0
+    stored_total = 0
+    stored_max = 0
+    for i, (op, key, size, now) in enumerate(events):
+        cache.expire(now)
+        if op == OP_PUT:
+            cache.put(key, size, now)
+            continue
+        hit = cache.get(key, now)
+        if not hit:
+            cache.put(key, size, now)
+        if i < counted_from:
+            continue
+        lookups += 1
+        if hit:
+            hits += 1
+        else:
+            fetched += size
+        stored_total += cache.stored
+        stored_max = max(stored_max, cache.stored)
+    return {
+        "lookups": lookups,
+        "hit_ratio": hits / lookups if lookups > 0 else 0,
+        "stored_kib_mean": stored_total / lookups / 1024 if lookups > 0 else 0,
+        "stored_kib_max": stored_max / 1024,
+        "fetched_kib": fetched / 1024
+    }
+
+def gcache_ttl(key):
+    # Retention rules of GCacheService.select_evictions
+    if len(key) > 50:
+        return 0
+    if len(key) > 20:
+        return 7 * 86400
+    return 30 * 86400
+
+# Priorities, the lowest is evicted first
+POLICIES = {
+    "lru": (lambda entry, cache: entry[2], None),
+    "lfu": (lambda entry, cache: entry[1], None),
+    # GreedyDual-Size-Frequency, small and often used entries stay longest
+    "size": (lambda entry, cache: cache.clock + entry[1] / max(entry[0], 1), None),
+    # What GCacheService.maintain does, see EVICTION_HIT_WEIGHT
+    "gcache": (lambda entry, cache: entry[2] + min(entry[1], 30) * 86400, gcache_ttl)
+}
+
+def parse_amount(text, units):
+    text = text.strip().lower()
+    if len(text) > 0 and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def make_caches(policies, capacities, ttls):
+    caches = []
+    for capacity in capacities:
+        for name in policies:
+            priority, ttl = POLICIES[name]
+            caches.append(GSimulatedCache(name, capacity, priority, ttl))
+    for name, seconds in ttls:
+        caches.append(GSimulatedCache(name, None, POLICIES["lru"][0], lambda key, seconds=seconds: seconds))
+    if len(ttls) > 0:
+        caches.append(GSimulatedCache("gcache-ttl", None, POLICIES["lru"][0], gcache_ttl))
+    return caches
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replays a cache access trace against eviction policies")
+    parser.add_argument("trace")
+    parser.add_argument("--capacity", default="256K,1M,4M,8M", help="byte budgets, K and M suffixes allowed")
+    parser.add_argument("--policy", default=",".join(POLICIES), help="budgeted policies: " + ", ".join(POLICIES))
+    parser.add_argument("--ttl", default="1d,7d,30d", help="unbudgeted expiry after the last access, "
+                                                           "h and d suffixes allowed, empty for none")
+    parser.add_argument("--warmup", type=float, default=0.1, help="share of events not counted while the caches fill")
+    args = parser.parse_args(argv)
+    capacities = list(map(lambda x: int(parse_amount(x, {"k": 1024, "m": 1024 * 1024})),
+                          filter(None, args.capacity.split(","))))
+    policies = list(filter(None, args.policy.split(",")))
+    for name in policies:
+        if name not in POLICIES:
+            parser.error("unknown policy {}".format(name))
+    ttls = list(map(lambda x: ("ttl-" + x.strip(), parse_amount(x, {"h": 3600, "d": 86400})),
+                    filter(None, args.ttl.split(","))))
+    try:
+        events = fill_sizes(list(read_trace(args.trace)))
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    print("{} events, {} keys".format(len(events), len(set(map(lambda x: x[1], events)))))
+    print("{:<12}{:>10}{:>10}{:>10}{:>12}{:>12}{:>12}".format(
+        "policy", "capacity", "lookups", "hit ratio", "stored KiB", "max KiB", "fetched KiB"))
+    for cache in make_caches(policies, capacities, ttls):
+        report = simulate(events, cache, args.warmup)
+        capacity = "-" if cache.capacity == None else "{}K".format(cache.capacity // 1024)
+        print("{:<12}{:>10}{:>10}{:>10.3f}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+            cache.name, capacity, report["lookups"], report["hit_ratio"],
+            report["stored_kib_mean"], report["stored_kib_max"], report["fetched_kib"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,26 +1,68 @@
 #! python3
 
+import itertools
+
+PAGE_SIZE = 6
+REQUEST_MAX_PAGES = 32
+
+# Suggestions are held by the thousand in the memory cache, all types use __slots__
+# so instances carry no per-instance __dict__
+
 class GSuggestion:
-    word = ""
-    annotation = ""
-    matched_length = 0
+    __slots__ = ("word", "annotation", "matched_length")
+
     def __init__(self, word, annotation, matched_length):
         self.word = word
         self.annotation = annotation
         self.matched_length = matched_length
 
 class GRequest:
-    request = ""
-    suggestions = []
-    requested_pages = 0
-    max_pages = 32
-    requested_time = 0
+    __slots__ = ("request", "suggestions", "requested_pages", "max_pages", "requested_time")
+
+    def __init__(self):
+        self.request = ""
+        self.suggestions = []
+        self.requested_pages = 0
+        self.max_pages = REQUEST_MAX_PAGES
+        self.requested_time = 0
+
+class GSuggestionView:
+    # Read-only view of parent[start:stop] that shares the parent list instead of copying it
+    __slots__ = ("parent", "start", "stop")
+
+    def __init__(self, parent, start, stop):
+        if isinstance(parent, GSuggestionView):
+            start, stop = parent.start + start, min(parent.start + stop, parent.stop)
+            parent = parent.parent
+        self.parent = parent
+        self.start = max(0, min(start, len(parent)))
+        self.stop = max(self.start, min(stop, len(parent)))
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("suggestion index out of range")
+        return self.parent[self.start + index]
+
+    def __iter__(self):
+        return itertools.islice(self.parent, self.start, self.stop)
+
+def page_view(suggestions, page_num):
+    # Suggestions of a page without copying them out of the request's list
+    return GSuggestionView(suggestions, page_num * PAGE_SIZE, (page_num + 1) * PAGE_SIZE)
 
 class GPage:
-    word = ""
-    page_num = 0
-    suggestions = []
-    def __init__(self, word, page_num, suggestions):
+    __slots__ = ("word", "page_num", "suggestions", "provisional")
+
+    def __init__(self, word, page_num, suggestions, provisional=False):
         self.word = word
         self.page_num = page_num
-        self.suggestions = suggestions
\ No newline at end of file
+        self.suggestions = suggestions # A list or a GSuggestionView
+        # Provisional pages are stand-ins until the real response arrives
+        self.provisional = provisional